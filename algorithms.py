@@ -1,8 +1,24 @@
+from __future__ import division
+
 import math
 import random
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+import multiprocessing
+import numpy as np
+from six.moves.queue import Empty
+from instrumentation import Stats
+from timings import Timings
 
 
 def get_clusters(subs, include_comments=False):
+    if isinstance(subs, Timings):
+        for cluster in subs.clusters(include_comments):
+            yield cluster
+        return
+
     lines = sorted(line for line in subs if not line.is_comment or include_comments)
     i = 0
 
@@ -30,34 +46,716 @@ def discretize(clusters, unit=100):
 
     return times
 
-def simulated_annealing_solver(x0, move, objective, t0, iterations, decay):
+def unit_intervals(clusters, unit=100):
+    """Returns arrays (starts, ends) of half-open unit ranges that discretize() would expand"""
+    bounds = np.array([(start//unit, end//unit) for start, end, _ in clusters], dtype=np.int64).reshape(-1, 2)
+    bounds = bounds[bounds[:, 0] < bounds[:, 1]]
+    return bounds[:, 0].copy(), bounds[:, 1].copy()
+
+def cluster_statistics(clusters):
+    """Returns (number, total duration, median duration) of clusters from get_clusters()"""
+    lengths = np.array([end - start for start, end, _ in clusters], dtype=np.float64)
+    if not len(lengths):
+        return 0, 0.0, 0.0
+    return len(lengths), float(lengths.sum()), float(np.median(lengths))
+
+def select_reference_track(tracks, subs):
+    """
+    Returns key of the SSAFile in tracks (dict) whose cluster statistics are closest to subs.
+
+    Distance is the sum of absolute log ratios of the statistics, so signs-only or partial
+    tracks lose to a full dialogue track. Ties go to the first track in iteration order.
+    """
+    target = cluster_statistics(get_clusters(subs))
+
+    def distance(track):
+        statistics = cluster_statistics(get_clusters(tracks[track]))
+        return sum(abs(math.log((a + 1) / (b + 1))) for a, b in zip(statistics, target))
+
+    return min(tracks, key=distance)
+
+class UnitMismatchObjective(object):
+    """
+    Callable objective len(ref_times ^ set(t+delta//unit for t in times)) backed by arrays.
+
+    Reference units are stored as a prefix sum of their occupancy bitmap, so the overlap
+    of one subtitle interval is a difference of two lookups. A call costs O(number of
+    subtitle clusters) and works in preallocated buffers.
+    """
+    def __init__(self, ref_clusters, clusters, unit=100):
+        self.unit = unit
+        ref_starts, ref_ends = unit_intervals(ref_clusters, unit)
+        self.starts, self.ends = unit_intervals(clusters, unit)
+
+        self.offset = int(ref_starts.min()) if len(ref_starts) else 0
+        size = int(ref_ends.max()) - self.offset if len(ref_ends) else 0
+        bitmap = np.zeros(size + 1, dtype=np.int64)
+        np.add.at(bitmap, ref_starts - self.offset, 1)
+        np.add.at(bitmap, ref_ends - self.offset, -1)
+        self.prefix = np.concatenate(([0], np.cumsum(np.cumsum(bitmap)[:-1] > 0)))
+
+        self.total = int(self.prefix[-1]) + int((self.ends - self.starts).sum())
+        self._lo = np.empty_like(self.starts)
+        self._hi = np.empty_like(self.ends)
+        self._lo_count = np.empty_like(self.starts)
+        self._hi_count = np.empty_like(self.ends)
+
+    def overlap(self, shift):
+        """Number of reference units covered by subtitle units shifted by integer number of units"""
+        np.add(self.starts, shift - self.offset, out=self._lo)
+        np.add(self.ends, shift - self.offset, out=self._hi)
+        np.clip(self._lo, 0, len(self.prefix) - 1, out=self._lo)
+        np.clip(self._hi, 0, len(self.prefix) - 1, out=self._hi)
+        self.prefix.take(self._lo, out=self._lo_count)
+        self.prefix.take(self._hi, out=self._hi_count)
+        return int(self._hi_count.sum() - self._lo_count.sum())
+
+    def __call__(self, delta):
+        return self.total - 2*self.overlap(int(delta//self.unit))
+
+class IntervalMismatchObjective(object):
+    """
+    Callable objective measuring exact non-overlapping duration of merged clusters, in units.
+
+    Works on (start, end) of clusters without discretization, so cost depends on number of
+    clusters only and any unit (down to 1 ms) can be used. Reference coverage is stored as
+    a piecewise linear function (covered ms up to time x), so overlap of a shifted subtitle
+    cluster is a difference of two interpolated values.
+    """
+    def __init__(self, ref_clusters, clusters, unit=100):
+        self.unit = unit
+        ref_bounds = np.array([(start, end) for start, end, _ in ref_clusters if start < end], dtype=np.float64)
+        bounds = np.array([(start, end) for start, end, _ in clusters if start < end], dtype=np.float64)
+        ref_bounds, bounds = ref_bounds.reshape(-1, 2), bounds.reshape(-1, 2)
+
+        ref_lengths = ref_bounds[:, 1] - ref_bounds[:, 0]
+        self.breakpoints = ref_bounds.ravel()
+        self.coverage = np.column_stack((np.cumsum(ref_lengths) - ref_lengths, np.cumsum(ref_lengths))).ravel()
+        if not len(self.breakpoints):
+            self.breakpoints, self.coverage = np.zeros(1), np.zeros(1)
+
+        self.starts, self.ends = bounds[:, 0].copy(), bounds[:, 1].copy()
+        self.ref_total = ref_lengths.sum()
+        self.total = self.ref_total + (self.ends - self.starts).sum()
+        self._lo = np.empty_like(self.starts)
+        self._hi = np.empty_like(self.ends)
+
+    def overlap(self, delta):
+        """Overlap of reference and subtitles shifted by delta, in ms"""
+        np.add(self.starts, delta, out=self._lo)
+        np.add(self.ends, delta, out=self._hi)
+        return (np.interp(self._hi, self.breakpoints, self.coverage).sum() -
+                np.interp(self._lo, self.breakpoints, self.coverage).sum())
+
+    def cluster_overlaps(self, deltas):
+        """Overlap of each subtitle cluster shifted by each of deltas, array of shape (len(deltas), clusters)"""
+        deltas = np.asarray(deltas, dtype=np.float64)[:, None]
+        return (np.interp(self.ends + deltas, self.breakpoints, self.coverage) -
+                np.interp(self.starts + deltas, self.breakpoints, self.coverage))
+
+    def __call__(self, delta):
+        return float(self.total - 2*self.overlap(delta)) / self.unit
+
+    def mismatch_of_shifts(self, deltas):
+        """
+        Mismatch in units of subtitle clusters each shifted by its own delta (array), like
+        PiecewiseShift does. Clusters shifted onto each other are merged first, so covered
+        time is not counted twice.
+        """
+        lo, hi = self.starts + deltas, self.ends + deltas
+        order = np.argsort(lo, kind="mergesort")
+        lo, hi = lo[order], hi[order]
+        first = np.flatnonzero(np.concatenate(([True], lo[1:] > np.maximum.accumulate(hi)[:-1])))
+        lo, hi = lo[first], np.maximum.reduceat(hi, first)
+        overlap = (np.interp(hi, self.breakpoints, self.coverage) -
+                   np.interp(lo, self.breakpoints, self.coverage)).sum()
+        return float(self.ref_total + (hi - lo).sum() - 2*overlap) / self.unit
+
+OBJECTIVES = {
+    "units": UnitMismatchObjective,
+    "intervals": IntervalMismatchObjective,
+}
+
+class MemoizedObjective(object):
+    """
+    Caches values of an objective that depends only on delta//unit (like UnitMismatchObjective).
+
+    Late in the annealing schedule most proposals land on already evaluated shifts, which then
+    cost a dict lookup. At most max_size values are kept, the oldest are dropped first.
+    Pickled copies (eg. in multistart worker processes) each keep their own cache.
+    """
+    def __init__(self, objective, max_size=2**16):
+        self.objective = objective
+        self.unit = objective.unit
+        self.max_size = max_size
+        self.values = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __call__(self, delta):
+        key = int(delta//self.unit)
+        try:
+            value = self.values[key]
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+
+        self.misses += 1
+        value = self.values[key] = self.objective(key*self.unit)
+        if len(self.values) > self.max_size:
+            self.values.popitem(last=False)
+        return value
+
+def cache_counters(objective):
+    """Returns dict of MemoizedObjective hit/miss counts, empty for other objectives"""
+    if isinstance(objective, MemoizedObjective):
+        return {"objective_cache_hits": objective.hits, "objective_cache_misses": objective.misses}
+    return {}
+
+def make_objective(name, ref_clusters, clusters, unit):
+    """Returns objective from OBJECTIVES by name, memoized per unit where it only depends on delta//unit"""
+    objective = OBJECTIVES[name](ref_clusters, clusters, unit)
+    if isinstance(objective, UnitMismatchObjective):
+        objective = MemoizedObjective(objective)
+    return objective
+
+class CancellationToken(object):
+    """Flag set from another thread (eg. a Stop button) to stop a running solver"""
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+class StopCondition(object):
+    """
+    Criteria for stopping a solver before it runs all iterations, all optional:
+    patience (iterations without a new best state), min_temperature, target (mismatch
+    at or below which the best state is good enough), time_limit (seconds since this
+    object was created) and token (CancellationToken).
+
+    After the solver finishes, reason says why: "completed" (ran to the end),
+    "patience", "temperature", "target", "time" or "cancelled".
+    """
+    def __init__(self, patience=None, min_temperature=None, target=None, time_limit=None, token=None):
+        self.patience = patience
+        self.min_temperature = min_temperature
+        self.target = target
+        self.time_limit = time_limit
+        self.token = token
+        self.started = time.time()
+        self.reason = None
+
+    def interrupted(self):
+        """Checks only cancellation and time limit, sets reason"""
+        if self.token is not None and self.token.cancelled:
+            self.reason = "cancelled"
+        elif self.time_limit is not None and time.time() - self.started > self.time_limit:
+            self.reason = "time"
+        return self.reason is not None
+
+    def check(self, stale, t, bestfx):
+        """Checks all criteria given iterations since last improvement, temperature and best mismatch"""
+        if self.patience is not None and stale >= self.patience:
+            self.reason = "patience"
+        elif self.min_temperature is not None and t < self.min_temperature:
+            self.reason = "temperature"
+        elif self.target is not None and bestfx <= self.target:
+            self.reason = "target"
+        else:
+            return self.interrupted()
+        return True
+
+    def for_chain(self):
+        """Returns copy for a multistart chain process, which is interrupted by the parent instead"""
+        return StopCondition(self.patience, self.min_temperature, self.target)
+
+def simulated_annealing_solver(x0, move, objective, t0, iterations, decay, rng=random, stats=None, stop=None):
+    stop = StopCondition() if stop is None else stop
     t = t0
     x, fx = x0, objective(x0)
     bestx, bestfx = x, fx
+    calls, accepted, best_i = 1, 0, 0
 
     for i in range(iterations):
         newx = move(x, t)
         newfx = objective(newx)
+        calls += 1
         delta = (newfx - fx)**2
 
-        if newfx < fx or math.exp(-delta/t) > random.random():
+        if newfx < fx or math.exp(-delta/t) > rng.random():
             x, fx = newx, newfx # keep the new state
+            accepted += 1
 
             if fx < bestfx:
-                bestx, bestfx = x, fx
+                bestx, bestfx, best_i = x, fx, i
 
         yield i, t, x, fx
         t *= decay
 
+        if stop.check(i - best_i, t, bestfx):
+            break
+    else:
+        stop.reason = "completed"
+
+    if stats is not None:
+        stats.count("objective_calls", calls)
+        stats.count("accepted_moves", accepted)
+    yield None, None, bestx, bestfx
+
+_chain_objective, _chain_queue = None, None
+
+def _init_chain_worker(objective, queue):
+    global _chain_objective, _chain_queue
+    _chain_objective, _chain_queue = objective, queue
+
+def _annealing_chain(args):
+    chain, seed, x0, t0, iterations, decay, report_every, stop = args
+    rng = random.Random(seed)
+    move = lambda x, t: rng.gauss(x, t)
+    bestx, bestfx = None, None
+    stats = Stats()
+    before = cache_counters(_chain_objective)
+
+    for i, t, x, fx in simulated_annealing_solver(x0, move, _chain_objective, t0, iterations, decay, rng=rng,
+                                                  stats=stats, stop=stop):
+        if i is None:
+            for name, n in cache_counters(_chain_objective).items():
+                stats.count(name, n - before[name]) # cache is shared by chains run in this process
+            return chain, x, fx, dict(stats.counters), stop.reason
+        if bestfx is None or fx < bestfx:
+            bestx, bestfx = x, fx
+        if (i+1) % report_every == 0:
+            _chain_queue.put((chain, i, t, bestx, bestfx))
+
+def multistart_solver(objective, t0, iterations, decay, chains, processes=None, seed=None, spread=None,
+                      report_every=100, stats=None, stop=None, x0=0):
+    """
+    Runs independent annealing chains in a process pool and returns the best of their results.
+
+    Chain 0 starts at x0, others uniformly in x0 +- spread (4*t0 by default). Seeds
+    and starting points are drawn from random.Random(seed), so a fixed seed gives the same
+    result regardless of scheduling. While running, yields (i, t, x, fx) with mean chain
+    progress i and best state found so far by any chain.
+
+    Chains stop on their own by patience, temperature and target of stop (StopCondition);
+    on cancellation or time limit the pool is terminated and the best reported state is
+    returned. stop.reason is that of the winning chain.
+    """
+    stop = StopCondition() if stop is None else stop
+    rng = random.Random(seed)
+    spread = 4*t0 if spread is None else spread
+    jobs = []
+    for chain in range(chains):
+        start = x0 if chain == 0 else x0 + rng.uniform(-spread, spread)
+        jobs.append((chain, rng.randrange(2**32), start, t0, iterations, decay, report_every, stop.for_chain()))
+
+    queue = multiprocessing.Queue()
+    # each worker unpickles the objective, don't start more than there are chains
+    processes = min(chains, processes or multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(processes, _init_chain_worker, (objective, queue))
+    try:
+        async_results = pool.map_async(_annealing_chain, jobs)
+        progress = [0] * chains
+        bestx, bestfx = None, None
+
+        while not async_results.ready() or not queue.empty():
+            if stop.interrupted():
+                break
+            try:
+                chain, i, t, x, fx = queue.get(timeout=0.05)
+            except Empty:
+                continue
+
+            progress[chain] = i+1
+            if bestfx is None or fx < bestfx:
+                bestx, bestfx = x, fx
+            yield sum(progress) // chains - 1, t, bestx, bestfx
+
+        if stop.reason is None:
+            results = async_results.get()
+            pool.close()
+    finally:
+        pool.terminate()
+
+    if stop.reason is not None:
+        if bestfx is None:
+            bestx, bestfx = x0, objective(x0)
+        yield None, None, bestx, bestfx
+        return
+
+    if stats is not None:
+        for result in results:
+            stats.merge(result[3])
+    _, bestx, bestfx, _, stop.reason = min(results, key=lambda result: (result[2], result[0]))
+    yield None, None, bestx, bestfx
+
+def annealing_decay(unit, t0, iterations):
+    """Returns decay which cools temperature from t0 down to unit in given number of iterations"""
+    return (unit / t0)**(1/iterations)
+
+def occupancy_vector(times):
+    """Returns (offset, array) with array[t-offset] == 1 for every time unit t in times"""
+    times = np.unique(np.fromiter(times, dtype=np.int64))
+    if not len(times):
+        return 0, np.zeros(0)
+
+    offset = times[0]
+    vector = np.zeros(times[-1] - offset + 1)
+    vector[times - offset] = 1
+    return int(offset), vector
+
+def cross_correlation(ref_times, times):
+    """
+    Returns arrays (shifts, overlap) with |A & (B+d)| for every shift d (in units) where the
+    discretized subtitles A = ref_times, B = times can overlap, computed via FFT
+    """
+    ref_offset, a = occupancy_vector(ref_times)
+    offset, b = occupancy_vector(times)
+
+    if not len(a) or not len(b):
+        return np.zeros(1, dtype=np.int64), np.zeros(1)
+
+    n = len(a) + len(b) - 1
+    size = 1 << (n - 1).bit_length()
+    overlap = np.fft.irfft(np.fft.rfft(a, size) * np.conj(np.fft.rfft(b, size)), size)
+    overlap = np.rint(np.concatenate((overlap[size-len(b)+1:], overlap[:len(a)])))
+
+    # overlap[k] corresponds to shift of (k - len(b) + 1) units relative to aligned vector starts
+    shifts = np.arange(-len(b) + 1, len(a)) + (ref_offset - offset)
+    return shifts, overlap
+
+def cross_correlation_solver(ref_times, times, unit):
+    """
+    Exhaustive search over all shifts at once, via FFT cross-correlation of occupancy vectors.
+
+    Mismatch of shift d is |A ^ (B+d)| = |A| + |B| - 2*|A & (B+d)|, where the overlap term
+    for every d is one entry of the cross-correlation of A and B. Ties are broken towards
+    the smallest absolute shift, so the result is deterministic.
+    """
+    ref_times, times = set(ref_times), set(times)
+    shifts, overlap = cross_correlation(ref_times, times)
+    mismatch = len(ref_times) + len(times) - 2*overlap
+
+    candidates = np.flatnonzero(mismatch == mismatch.min())
+    best = candidates[np.argmin(np.abs(shifts[candidates]))]
+
+    yield None, None, int(shifts[best])*unit, int(mismatch[best])
+
+def pyramid_levels(unit, coarse_unit=1000, factor=10):
+    """Returns units of pyramid search levels, from coarse_unit down to unit"""
+    levels = [max(coarse_unit, unit)]
+    while levels[-1] > unit:
+        levels.append(max(levels[-1] // factor, unit))
+    return levels
+
+def pyramid_solver(ref_clusters, clusters, unit, coarse_unit=1000, factor=10, window=2, stop=None):
+    """
+    Coarse-to-fine search: exact cross-correlation at coarse_unit over the full range,
+    then exhaustive search at each finer unit within +- window previous units of the best
+    shift so far. Mismatch is always measured by IntervalMismatchObjective at the final unit.
+
+    Yields (level, level_unit, x, fx) after each level, then (None, None, bestx, bestfx).
+    Finer levels are skipped when stop (StopCondition) is cancelled or out of time.
+    """
+    stop = StopCondition() if stop is None else stop
+    objective = IntervalMismatchObjective(ref_clusters, clusters, unit)
+    levels = pyramid_levels(unit, coarse_unit, factor)
+
+    coarse = levels[0]
+    for _, _, bestx, _ in cross_correlation_solver(discretize(ref_clusters, coarse), discretize(clusters, coarse), coarse):
+        pass
+    bestfx = objective(bestx)
+    yield 0, coarse, bestx, bestfx
+
+    for level in range(1, len(levels)):
+        if stop.interrupted():
+            break
+        previous, current = levels[level-1], levels[level]
+        radius = -(-window*previous // current) * current
+        for x in range(bestx - radius, bestx + radius + 1, current):
+            fx = objective(x)
+            if fx < bestfx or (fx == bestfx and abs(x) < abs(bestx)):
+                bestx, bestfx = x, fx
+
+        yield level, current, bestx, bestfx
+
     yield None, None, bestx, bestfx
 
-def solver_driver(ref_subs, subs, unit, t0, decay, iterations):
-    ref_times = set(discretize(get_clusters(ref_subs), unit))
-    times = set(discretize(get_clusters(subs), unit))
+class PiecewiseShift(object):
+    """
+    Shift which differs between time ranges of the subtitles being retimed.
+
+    Line starting at t (before shifting) is shifted by shifts[i], where i is the number of
+    boundaries <= t. There is one more shift than boundaries.
+    """
+    def __init__(self, boundaries, shifts):
+        self.boundaries = list(boundaries)
+        self.shifts = list(shifts)
+
+    def shift_at(self, t):
+        return self.shifts[bisect_right(self.boundaries, t)]
+
+    def apply(self, subs):
+        for line in subs:
+            delta = int(round(self.shift_at(line.start)))
+            line.start += delta
+            line.end += delta
+
+    def to_json(self):
+        return {"boundaries": self.boundaries, "shifts": self.shifts}
+
+    def __repr__(self):
+        return "<PiecewiseShift boundaries=%r shifts=%r>" % (self.boundaries, self.shifts)
+
+class LinearTransform(object):
+    """Combined framerate correction and shift, line times t become scale*t + offset"""
+    def __init__(self, scale, offset):
+        self.scale = scale
+        self.offset = offset
+
+    def apply(self, subs):
+        for line in subs:
+            line.start = int(round(self.scale*line.start + self.offset))
+            line.end = int(round(self.scale*line.end + self.offset))
+
+    def to_json(self):
+        return {"scale": self.scale, "offset": self.offset}
+
+    def __repr__(self):
+        return "<LinearTransform scale=%r offset=%r>" % (self.scale, self.offset)
+
+def apply_shift(subs, x):
+    """Shifts subs in place by x, which is either ms or an object with apply() like PiecewiseShift"""
+    if hasattr(x, "apply"):
+        x.apply(subs)
+    else:
+        subs.shift(ms=x)
+
+def candidate_shifts(ref_clusters, clusters, unit, count=16, separation=2000):
+    """
+    Returns up to count shifts in ms with locally highest overlap of discretized subtitles,
+    at least separation ms apart, in order of decreasing overlap
+    """
+    shifts, overlap = cross_correlation(discretize(ref_clusters, unit), discretize(clusters, unit))
+    radius = max(1, separation // unit)
+    taken = np.zeros(len(shifts), dtype=bool)
+    candidates = []
+
+    for k in np.argsort(-overlap, kind="mergesort"):
+        if len(candidates) == count or overlap[k] <= 0:
+            break
+        if not taken[k]:
+            candidates.append(int(shifts[k])*unit)
+            taken[max(0, k-radius):k+radius+1] = True
+
+    return candidates or [0]
+
+def piecewise_solver(ref_clusters, clusters, unit, switch_penalty=5000, count=16, separation=2000):
+    """
+    Segmented alignment for releases with inserted or removed parts.
+
+    Candidate shifts are the strongest peaks of the global cross-correlation (every aligned
+    section of the file makes its own peak). Each subtitle cluster then gets one of them by
+    dynamic programming (Viterbi) over clusters in time order, minimizing the non-overlapping
+    duration of clusters plus switch_penalty ms for every change of shift. This is
+    O(clusters * count) after the FFT.
+
+    Yields (None, None, PiecewiseShift, mismatch in units).
+    """
+    objective = IntervalMismatchObjective(ref_clusters, clusters, unit)
+    offsets = np.array(candidate_shifts(ref_clusters, clusters, unit, count, separation), dtype=np.float64)
+    n, k = len(objective.starts), len(offsets)
+
+    if not n:
+        yield None, None, PiecewiseShift([], [0]), objective(0)
+        return
+
+    overlaps = objective.cluster_overlaps(offsets)
+    costs = (objective.ends - objective.starts)[None, :] - overlaps
+    states = np.arange(k)
+    previous = np.empty((n, k), dtype=np.intp)
+    total = costs[:, 0].copy()
+
+    for i in range(1, n):
+        j = np.argmin(total)
+        switch = total[j] + switch_penalty < total
+        previous[i] = np.where(switch, j, states)
+        total = np.where(switch, total[j] + switch_penalty, total) + costs[:, i]
+
+    path = np.empty(n, dtype=np.intp)
+    path[-1] = np.argmin(total)
+    for i in range(n-1, 0, -1):
+        path[i-1] = previous[i, path[i]]
+
+    boundaries, shifts = [], [float(offsets[path[0]])]
+    for i in np.flatnonzero(path[1:] != path[:-1]) + 1:
+        boundaries.append(float(objective.ends[i-1] + objective.starts[i]) / 2)
+        shifts.append(float(offsets[path[i]]))
+
+    yield None, None, PiecewiseShift(boundaries, shifts), objective.mismatch_of_shifts(offsets[path])
+
+# Ratios of common framerates (PAL 25, film 24, NTSC film 23.976, NTSC video 29.97)
+FRAMERATE_RATIOS = sorted(set(a/b for a in (25, 24, 24000/1001, 30000/1001)
+                                for b in (25, 24, 24000/1001, 30000/1001) if a != b))
+
+def scale_clusters(clusters, scale):
+    return [(int(round(start*scale)), int(round(end*scale)), lines) for start, end, lines in clusters]
+
+def best_offset_for_scale(ref_clusters, clusters, unit, scale):
+    """Returns (mismatch in units, offset) of best offset for subtitles scaled by scale, via FFT"""
+    scaled = scale_clusters(clusters, scale)
+    shifts, overlap = cross_correlation(discretize(ref_clusters, unit), discretize(scaled, unit))
+    offset = int(shifts[np.argmax(overlap)])*unit
+    return IntervalMismatchObjective(ref_clusters, scaled, unit)(offset), offset
+
+def vote_scales(ref_clusters, clusters, min_scale=0.8, max_scale=1.25, bin_width=1e-4, window=0.05,
+                tolerance=0.1, samples=200000, seed=0):
+    """
+    Returns scales in order of decreasing votes, from Hough voting over pairs of correspondences.
+
+    A correspondence pairs subtitle cluster with reference cluster of similar duration
+    (within tolerance) at similar relative position in the file (within window). Two
+    correspondences determine scale and offset; pairs are sampled at random (seeded), and
+    (scale, offset) of consistent ones pile up in a single bin.
+    """
+    ref = np.array([(start, end) for start, end, _ in ref_clusters], dtype=np.float64).reshape(-1, 2)
+    subs = np.array([(start, end) for start, end, _ in clusters], dtype=np.float64).reshape(-1, 2)
+    if len(ref) < 2 or len(subs) < 2:
+        return [1.0]
+
+    def relative(times):
+        return (times - times[0]) / max(times[-1] - times[0], 1)
+
+    ref_position, subs_position = relative(ref[:, 0]), relative(subs[:, 0])
+    ref_duration, subs_duration = ref[:, 1] - ref[:, 0], subs[:, 1] - subs[:, 0]
+
+    first = np.searchsorted(ref_position, subs_position - window)
+    last = np.searchsorted(ref_position, subs_position + window)
+    pairs = [(i, k) for i in range(len(subs)) for k in range(first[i], last[i])
+             if abs(ref_duration[k] - subs_duration[i]) <= tolerance*subs_duration[i]]
+    if len(pairs) < 2:
+        return [1.0]
+    pairs = np.array(pairs)
+
+    rng = np.random.RandomState(seed)
+    a, b = pairs[rng.randint(len(pairs), size=samples)], pairs[rng.randint(len(pairs), size=samples)]
+    span = subs[b[:, 0], 0] - subs[a[:, 0], 0]
+    valid = np.abs(span) > 0
+    scale = (ref[b[valid, 1], 0] - ref[a[valid, 1], 0]) / span[valid]
+    offset = ref[a[valid, 1], 0] - scale*subs[a[valid, 0], 0]
+    valid = (scale >= min_scale) & (scale <= max_scale)
+    scale, offset = scale[valid], offset[valid]
+    if not len(scale):
+        return [1.0]
+
+    scale_bins = np.rint((scale - min_scale) / bin_width).astype(np.int64)
+    offset_bins = np.rint(offset / 1000).astype(np.int64)
+    keys = scale_bins * (2*(np.abs(offset_bins).max() + 1)) + offset_bins
+    values, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    order = np.argsort(-counts, kind="mergesort")
+
+    scales = []
+    for index in order[:8]:
+        scales.append(float(np.median(scale[inverse.ravel() == index])))
+    return scales
+
+def drift_solver(ref_clusters, clusters, unit, ratios=FRAMERATE_RATIOS, good_fit=0.1, refine_steps=10, stop=None,
+                 **vote_kwargs):
+    """
+    Finds LinearTransform (scale and offset) for framerate mismatch.
+
+    Fast path tries no scaling and standard framerate ratios, each with exact FFT offset.
+    If none of them leaves mismatch below good_fit of total subtitle duration, scales from
+    vote_scales() are tried, and the best scale is refined on a grid of 1/refine_steps of
+    the voting bin. Yields (i, scale, offset, fx) for every scale tried, then
+    (None, None, LinearTransform, fx). When stop (StopCondition) is cancelled or out of
+    time, the best scale tried so far is returned.
+    """
+    stop = StopCondition() if stop is None else stop
+    objective = IntervalMismatchObjective(ref_clusters, clusters, unit)
+    total = objective.total / unit
+    tried = {}
+
+    def evaluate(scale):
+        if scale not in tried:
+            tried[scale] = best_offset_for_scale(ref_clusters, clusters, unit, scale)
+        return tried[scale]
+
+    candidates = [1.0] + list(ratios)
+    for i, scale in enumerate(candidates):
+        if i > 0 and stop.interrupted():
+            break
+        fx, offset = evaluate(scale)
+        yield i, scale, offset, fx
+
+    best_scale = min(tried, key=lambda scale: tried[scale])
+    if tried[best_scale][0] > good_fit*total and stop.reason is None:
+        bin_width = vote_kwargs.get("bin_width", 1e-4)
+        for scale in vote_scales(ref_clusters, clusters, **vote_kwargs):
+            if stop.interrupted():
+                break
+            fx, offset = evaluate(scale)
+            yield len(tried), scale, offset, fx
+
+        center = min(tried, key=lambda scale: tried[scale])
+        for step in range(-refine_steps, refine_steps+1):
+            if stop.interrupted():
+                break
+            scale = center + step*bin_width/refine_steps
+            fx, offset = evaluate(scale)
+            yield len(tried), scale, offset, fx
+        best_scale = min(tried, key=lambda scale: tried[scale])
+
+    fx, offset = tried[best_scale]
+    yield None, None, LinearTransform(best_scale, offset), fx
+
+def solver_driver(ref_subs, subs, unit, t0=None, decay=None, iterations=None, method="annealing", objective="units",
+                  chains=1, processes=None, seed=None, stats=None, stop=None, x0=0):
+    """
+    Yields (i, t, x, fx) progress of the chosen solver, ending with (None, None, best x, best fx).
+    Annealing starts from shift x0 (eg. a quick estimate), other methods search globally.
+    Time spent clustering and solving (not in the consumer) and solver counters go to stats.
+    Solvers stop early as decided by stop (StopCondition), whose reason is set at the end.
+    """
+    stats = Stats() if stats is None else stats
+    stop = StopCondition() if stop is None else stop
+    with stats.stage("cluster"):
+        ref_clusters = list(get_clusters(ref_subs))
+        clusters = list(get_clusters(subs))
 
-    x0 = 0
-    move = lambda x, t: random.gauss(x, t)
-    objective = lambda delta: len(ref_times ^ set(t+delta//unit for t in times))
+    t = time.time()
+    if method == "fft":
+        solver = cross_correlation_solver(discretize(ref_clusters, unit), discretize(clusters, unit), unit)
+    elif method == "drift":
+        solver = drift_solver(ref_clusters, clusters, unit, stop=stop)
+    elif method == "piecewise":
+        solver = piecewise_solver(ref_clusters, clusters, unit)
+    elif method == "pyramid":
+        solver = pyramid_solver(ref_clusters, clusters, unit, stop=stop)
+    elif method == "annealing" and chains > 1:
+        objective = make_objective(objective, ref_clusters, clusters, unit)
+        solver = multistart_solver(objective, t0, iterations, decay, chains, processes=processes, seed=seed,
+                                   stats=stats, stop=stop, x0=x0)
+    elif method == "annealing":
+        rng = random if seed is None else random.Random(seed)
+        move = lambda x, t: rng.gauss(x, t)
+        objective = make_objective(objective, ref_clusters, clusters, unit)
+        solver = simulated_annealing_solver(x0, move, objective, t0, iterations=iterations, decay=decay, rng=rng,
+                                            stats=stats, stop=stop)
+    else:
+        raise ValueError("Unknown solver method %r" % method)
 
-    for data in simulated_annealing_solver(x0, move, objective, t0, iterations=iterations, decay=decay):
+    for data in solver:
+        stats.add_time("solve", time.time() - t)
+        if data[0] is None:
+            if chains <= 1: # chains report their own counters
+                stats.merge(cache_counters(objective))
+            if stop.reason is None:
+                stop.reason = "completed"
         yield data
+        t = time.time()
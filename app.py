@@ -8,55 +8,72 @@ from PyQt4.QtGui import QApplication, QMainWindow, QMessageBox
 import pysubs2
 from ui_mainwindow import Ui_MainWindow
 from selectfilewidget import SelectFileWidget
-from algorithms import solver_driver
-from mkvhandler import extract_subtitle_track
+from algorithms import pyramid_levels, annealing_decay, PiecewiseShift, LinearTransform, FRAMERATE_RATIOS, \
+    CancellationToken, StopCondition
+from cache import SubtitleCache
+from instrumentation import Stats
+from pipeline import retime
+from progress import ProgressChannel
 
 # ----------------------------------------------------------------------------------------------------------------------
 
 def time_to_str(ms):
     return pysubs2.time.ms_to_str(ms, fractions=True)
 
+def shift_to_str(x):
+    if isinstance(x, PiecewiseShift):
+        return " | ".join(time_to_str(shift) for shift in x.shifts)
+    elif isinstance(x, LinearTransform):
+        return "%s (x%.6f)" % (time_to_str(x.offset), x.scale)
+    else:
+        return time_to_str(x)
+
 class Worker(QThread):
     ENCODING = "latin-1"
+    CACHE = SubtitleCache()
 
-    updated = pyqtSignal(int, float, float, int)
-    done = pyqtSignal(float, float)
+    updated = pyqtSignal(object)
+    estimated = pyqtSignal(object, float)
+    done = pyqtSignal(object, float, _str)
+    reported = pyqtSignal(object)
     failed = pyqtSignal(_str)
 
-    def __init__(self, parent, ref_path, subs_path, write_file, settings):
+    def __init__(self, parent, ref_path, subs_path, write_file, settings, stop, sample_lines=None):
         QThread.__init__(self, parent)
         self.ref_path = ref_path
         self.subs_path = subs_path
         self.settings = settings
         self.write_file = write_file
+        self.stop = stop
+        self.sample_lines = sample_lines
 
     def run(self):
         try:
-            if self.ref_path.lower().endswith(".mkv"):
-                ref_subs = extract_subtitle_track(self.ref_path)
-            else:
-                ref_subs = pysubs2.load(self.ref_path, self.ENCODING)
-
-            subs = pysubs2.load(self.subs_path, self.ENCODING)
-            delta, error = None, None
-
-            for i, t, x, fx in solver_driver(ref_subs, subs, **self.settings):
-                if i is None:
-                    delta, error = x, fx
-                else:
-                    self.updated.emit(i, t, x, fx)
-
-            if self.write_file:
-                subs.shift(ms=delta)
-                subs.save(self.subs_path, self.ENCODING)
-
-            self.done.emit(delta, error)
+            stats = Stats()
+            progress = ProgressChannel(self.updated.emit)
+            delta, error = retime(self.ref_path, self.subs_path, self.settings, self.write_file,
+                                  progress=progress, cache=self.CACHE, encoding=self.ENCODING, stats=stats,
+                                  stop=self.stop, sample_lines=self.sample_lines, refine=self.write_file,
+                                  estimated=self.estimated.emit, processes=None)
+            progress.flush()
+            self.reported.emit(stats)
+            self.done.emit(delta, error, self.stop.reason)
         except Exception as exc:
             self.failed.emit(traceback.format_exc(exc))
 
 # ----------------------------------------------------------------------------------------------------------------------
 
 class MainWindow(QMainWindow, Ui_MainWindow):
+    METHODS = ("annealing", "fft", "pyramid", "piecewise", "drift")
+    QUICK_SAMPLE_LINES = 200
+    STOP_REASONS = {
+        "patience": "Converged",
+        "temperature": "Converged",
+        "target": "Target reached",
+        "time": "Out of time",
+        "cancelled": "Stopped",
+    }
+
     def __init__(self, parent=None):
         super(MainWindow, self).__init__(parent)
         self.setupUi(self)
@@ -69,12 +86,31 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.dryRunButton.clicked.connect(lambda: self.start_processing(False))
         self.runButton.clicked.connect(lambda: self.start_processing(True))
+        self.stopButton.clicked.connect(self.stop_processing)
+        self.token = None
+
+        self.methodComboBox.addItems([self.tr("Simulated annealing"),
+                                      self.tr("Cross-correlation (exact)"),
+                                      self.tr("Coarse-to-fine"),
+                                      self.tr("Piecewise (cut/inserted scenes)"),
+                                      self.tr("Framerate drift")])
+        self.methodComboBox.currentIndexChanged.connect(self.method_changed)
 
         self.compute_decay()
         self.iterationsSpinBox.valueChanged.connect(self.compute_decay)
         self.unitSpinBox.valueChanged.connect(self.compute_decay)
         self.stepSizeSpinBox.valueChanged.connect(self.compute_decay)
 
+    def get_method(self):
+        return self.METHODS[self.methodComboBox.currentIndex()]
+
+    def method_changed(self):
+        annealing = self.get_method() == "annealing"
+        self.stepSizeSpinBox.setEnabled(annealing)
+        self.iterationsSpinBox.setEnabled(annealing)
+        self.continuousCheckBox.setEnabled(annealing)
+        self.chainsSpinBox.setEnabled(annealing)
+
     def get_t0(self):
         return int(self.stepSizeSpinBox.value()) * 1000
 
@@ -94,45 +130,79 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 "t0": self.get_t0(),
                 "decay": float(self.decaySpinBox.value()),
                 "iterations": int(self.iterationsSpinBox.value()),
+                "method": self.get_method(),
+                "objective": "intervals" if self.continuousCheckBox.isChecked() else "units",
+                "chains": int(self.chainsSpinBox.value()),
             }
 
+            if settings["method"] == "pyramid":
+                self.progress_maximum = len(pyramid_levels(settings["unit"]))
+            elif settings["method"] == "drift":
+                self.progress_maximum = len(FRAMERATE_RATIOS) + 1
+            else:
+                self.progress_maximum = settings["iterations"]
+
             self.progressBar.setMaximum(0)
+            self.progressBar.setFormat("%p%")
 
-            self.thread = Worker(self, self.refFile.path, self.subsFile.path, write_file, settings)
+            self.token = CancellationToken()
+            stop = StopCondition(patience=max(settings["iterations"] // 4, 1), min_temperature=settings["unit"],
+                                 token=self.token)
+            sample_lines = self.QUICK_SAMPLE_LINES if self.quickCheckBox.isChecked() else None
+            self.thread = Worker(self, self.refFile.path, self.subsFile.path, write_file, settings, stop, sample_lines)
             self.thread.updated.connect(self.updated)
+            self.thread.estimated.connect(self.estimated)
             self.thread.done.connect(self.done)
+            self.thread.reported.connect(self.reported)
             self.thread.failed.connect(self.failed)
             self.thread.start()
         except Exception as exc:
             QMessageBox.critical(self, self.tr("Error"), traceback.format_exc(exc))
             self.enableButtons(True)
 
+    def stop_processing(self):
+        if self.token is not None:
+            self.token.cancel()
+            self.stopButton.setEnabled(False)
+
     def getUnit(self):
         return self.unitSpinBox.value()
 
     def enableButtons(self, enabled):
         self.runButton.setEnabled(enabled)
         self.dryRunButton.setEnabled(enabled)
+        self.stopButton.setEnabled(not enabled)
         self.refFile.setEnabled(enabled)
         self.subsFile.setEnabled(enabled)
 
-    def updated(self, i, t, x, fx):
-        if i % 2 > 0: return
-
-        self.progressBar.setMaximum(int(self.iterationsSpinBox.value()))
-        self.progressBar.setValue(i+1)
-        self.stepSizeDisplay.setValue(t/1000)
-        self.shiftDisplay.setText(time_to_str(x))
-        self.mismatchDisplay.setValue(fx/self.getUnit())
+    def updated(self, progress):
+        self.progressBar.setMaximum(self.progress_maximum)
+        self.progressBar.setValue(progress.i+1)
+        self.stepSizeDisplay.setValue(progress.t/1000)
+        self.shiftDisplay.setText(time_to_str(progress.bestx))
+        self.mismatchDisplay.setValue(progress.bestfx/self.getUnit())
 
     def failed(self, trace):
         self.enableButtons(True)
         self.progressBar.setMaximum(1)
         QMessageBox.critical(self, self.tr("Error"), trace)
 
-    def done(self, x, fx):
+    def estimated(self, x, fx):
+        self.shiftDisplay.setText(shift_to_str(x))
+        self.mismatchDisplay.setValue(fx/self.getUnit())
+
+    def reported(self, stats):
+        self.statusBar().showMessage(stats.summary())
+
+    def done(self, x, fx, reason):
+        if not self.progressBar.maximum():
+            self.progressBar.setMaximum(1)
         self.progressBar.setValue(self.progressBar.maximum())
-        self.shiftDisplay.setText(time_to_str(x))
+        if reason == "cancelled" and self.thread.write_file:
+            self.progressBar.setFormat(self.tr("Stopped, not saved"))
+        elif reason in self.STOP_REASONS:
+            self.progressBar.setFormat(self.tr(self.STOP_REASONS[reason]))
+        self.shiftDisplay.setText(shift_to_str(x))
         self.mismatchDisplay.setValue(fx/self.getUnit())
         self.enableButtons(True)
 
@@ -148,7 +218,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         unit = int(self.unitSpinBox.value())
         t0 = self.get_t0()
 
-        decay = (unit / t0)**(1/n)
+        decay = annealing_decay(unit, t0, n)
         self.decaySpinBox.setValue(decay)
         if decay < 0.95:
             self.decaySpinBox.setStyleSheet("color: red")
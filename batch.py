@@ -0,0 +1,170 @@
+from __future__ import division, unicode_literals
+
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from six.moves import queue
+from algorithms import StopCondition
+from instrumentation import Stats
+from pipeline import ENCODING, load_pair, solve_pair, save_shifted, was_written
+
+DONE = object() # end of input, passed on by the last worker of a stage
+
+
+class BatchJob(object):
+    """
+    One pair passing through the stages: loaded subtitles, then the result or traceback in failed.
+    stop (StopCondition) is created when solving starts, so its time limit doesn't include waiting.
+    """
+    def __init__(self, ref_path, subs_path, stats):
+        self.ref_path = ref_path
+        self.subs_path = subs_path
+        self.stats = stats
+        self.stop = None
+        self.subs, self.timings, self.ref_timings = None, None, None
+        self.delta, self.error, self.estimate = None, None, None
+        self.written = False
+        self.failed = None
+
+
+class Stage(object):
+    """
+    Worker threads taking items from inbox and putting function(item) to outbox (bounded queues).
+
+    Seconds the workers spend in function (busy), waiting for input (starved) and waiting
+    for space in outbox (blocked) are summed, so utilization() tells which stage needs more
+    workers: a busy stage holds up the others, a mostly blocked one waits for the next stage.
+    """
+    def __init__(self, name, function, inbox, outbox, workers=1):
+        self.name = name
+        self.function = function
+        self.inbox = inbox
+        self.outbox = outbox
+        self.workers = workers
+        self.busy, self.starved, self.blocked = 0.0, 0.0, 0.0
+        self.items = 0
+        self.running = workers
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.run, name="%s-%d" % (name, i)) for i in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True # don't keep the interpreter alive if the consumer gives up
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            t0 = time.time()
+            item = self.inbox.get()
+            t1 = time.time()
+            if item is DONE:
+                self.inbox.put(DONE) # for other workers of this stage
+                break
+            result = self.function(item)
+            t2 = time.time()
+            self.outbox.put(result)
+            t3 = time.time()
+            with self.lock:
+                self.starved += t1 - t0
+                self.busy += t2 - t1
+                self.blocked += t3 - t2
+                self.items += 1
+
+        with self.lock:
+            self.running -= 1
+            last = not self.running
+        if last:
+            self.outbox.put(DONE)
+
+    def utilization(self, elapsed):
+        """Returns dict with stage times and busy fraction of worker time over elapsed seconds"""
+        return {
+            "workers": self.workers,
+            "items": self.items,
+            "busy": self.busy,
+            "starved": self.starved,
+            "blocked": self.blocked,
+            "utilization": self.busy / (elapsed * self.workers) if elapsed > 0 else 0.0,
+        }
+
+
+def retime_batch(pairs, settings, write_file=False, cache=None, encoding=ENCODING, stop_criteria=None,
+                 sample_lines=None, refine=False, processes=1, loaders=1, solvers=1, writers=1, prefetch=2,
+                 utilization=None):
+    """
+    Retimes (reference, subtitles) pairs like pipeline.retime does, yielding finished BatchJobs
+    (with stats and stop of each pair) in order of completion.
+
+    Pairs go through load (reading subtitles, extracting references), solve and save stages
+    running in loaders, solvers and writers threads, so the next pairs are loaded and
+    the previous ones written while a pair is being solved. Stages are connected by queues
+    of prefetch jobs, a stage waits when the next one falls behind, so only a few loaded
+    pairs are in memory however many there are. Solvers share the GIL with the other stages,
+    more than one helps only with multistart chains or FFT (which run outside of it).
+
+    With utilization (dict), it is filled with Stage.utilization() of each stage and
+    "elapsed" seconds when all pairs are done.
+    """
+    stop_criteria = stop_criteria or {}
+    pending = queue.Queue()
+    loaded = queue.Queue(prefetch)
+    solved = queue.Queue(prefetch)
+    finished = queue.Queue(prefetch)
+
+    def load(job):
+        try:
+            job.subs, job.timings, job.ref_timings = load_pair(job.ref_path, job.subs_path, cache, encoding, job.stats,
+                                                               sample_lines, processes)
+        except Exception:
+            job.failed = traceback.format_exc()
+        return job
+
+    def solve(job):
+        if job.failed is None:
+            estimates = []
+            job.stop = StopCondition(**stop_criteria)
+            try:
+                job.delta, job.error = solve_pair(job.ref_path, job.ref_timings, job.timings, settings, cache=cache,
+                                                  encoding=encoding, stats=job.stats, stop=job.stop,
+                                                  sample_lines=sample_lines, refine=refine, processes=processes,
+                                                  estimated=lambda x, fx: estimates.append(x))
+            except Exception:
+                job.failed = traceback.format_exc()
+            job.estimate = estimates[0] if estimates else None
+        job.ref_timings, job.timings = None, None # only subs are needed to save
+        return job
+
+    def save(job):
+        if job.failed is None and was_written(write_file, job.stop):
+            try:
+                save_shifted(job.subs, job.subs_path, job.delta, encoding, job.stats)
+                job.written = True
+            except Exception:
+                job.failed = traceback.format_exc()
+        job.subs = None
+        return job
+
+    stages = [Stage("load", load, pending, loaded, loaders),
+              Stage("solve", solve, loaded, solved, solvers),
+              Stage("save", save, solved, finished, writers)]
+
+    for ref_path, subs_path in pairs:
+        pending.put(BatchJob(ref_path, subs_path, Stats()))
+    pending.put(DONE)
+
+    started = time.time()
+    for stage in stages:
+        stage.start()
+
+    while True:
+        job = finished.get()
+        if job is DONE:
+            break
+        yield job
+
+    if utilization is not None:
+        elapsed = time.time() - started
+        utilization["elapsed"] = elapsed
+        utilization["stages"] = OrderedDict((stage.name, stage.utilization(elapsed)) for stage in stages)
@@ -0,0 +1 @@
+"""Offline benchmarks for the retiming hot paths, run as ``python -m benchmarks.<name>``"""
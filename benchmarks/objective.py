@@ -0,0 +1,41 @@
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import random
+import timeit
+from algorithms import get_clusters, discretize, UnitMismatchObjective, IntervalMismatchObjective
+from benchmarks.synthetic import make_subtitles, make_retimed
+
+
+def set_objective(ref_clusters, clusters, unit):
+    """The original set-based objective of solver_driver, kept for comparison"""
+    ref_times = set(discretize(ref_clusters, unit))
+    times = set(discretize(clusters, unit))
+    return lambda delta: len(ref_times ^ set(t+delta//unit for t in times))
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-iteration cost of the annealing objective")
+    parser.add_argument("--minutes", type=int, default=120)
+    parser.add_argument("--unit", type=int, default=100)
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    ref_subs = make_subtitles(duration=args.minutes*60*1000)
+    subs = make_retimed(ref_subs)
+    ref_clusters = list(get_clusters(ref_subs))
+    clusters = list(get_clusters(subs))
+
+    rng = random.Random(0)
+    deltas = [rng.gauss(0, 20000) for _ in range(args.calls)]
+    objectives = [
+        ("set", set_objective(ref_clusters, clusters, args.unit)),
+        ("array", UnitMismatchObjective(ref_clusters, clusters, args.unit)),
+        ("interval", IntervalMismatchObjective(ref_clusters, clusters, args.unit)),
+    ]
+
+    for name, objective in objectives: # tests/test_solvers.py checks that "array" equals "set"
+        seconds = timeit.timeit(lambda: [objective(delta) for delta in deltas], number=1)
+        print("%-8s %10.1f us/iteration" % (name, 1e6*seconds/len(deltas)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import mmap
+import os
+import shutil
+import tempfile
+import time
+from io import open
+import mkvparse
+from mkvhandler import extract_subtitle_track
+from benchmarks.synthetic import make_subtitles, make_mkv
+
+
+class CountingHandler(mkvparse.MatroskaHandler):
+    def __init__(self):
+        self.frames = 0
+
+    def frame(self, track_id, timestamp, data, more_laced_frames, duration, keyframe, invisible, discardable):
+        self.frames += 1
+
+def parse_file(path):
+    with open(path, "rb") as fp:
+        mkvparse.mkvparse(fp, CountingHandler())
+
+def parse_mmap(path):
+    with open(path, "rb") as fp:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            mkvparse.mkvparse_buffer(data, CountingHandler())
+        finally:
+            data.close()
+
+def timeit_once(function, path):
+    t = time.time()
+    function(path)
+    return time.time() - t
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse throughput of file-object and mmap MKV parsers")
+    parser.add_argument("--minutes", type=int, default=10)
+    parser.add_argument("--lacing", default="xiph", choices=["xiph", "ebml", "fixed", "none"])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "synthetic.mkv")
+        make_mkv(path, make_subtitles(duration=args.minutes*60*1000), audio_lacing=args.lacing)
+        megabytes = os.path.getsize(path) / 2**20
+
+        for name, function in [("file", parse_file), ("mmap", parse_mmap), ("subtitles", extract_subtitle_track)]:
+            seconds = min(timeit_once(function, path) for _ in range(args.repeat))
+            print("%-10s %8.1f MB/s" % (name, megabytes/seconds))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from algorithms import get_clusters, discretize, simulated_annealing_solver, solver_driver, annealing_decay, \
+    UnitMismatchObjective, IntervalMismatchObjective
+from mkvhandler import extract_subtitle_track
+from timings import Timings
+from benchmarks.synthetic import make_subtitles, make_retimed, make_mkv
+from benchmarks.objective import set_objective
+from benchmarks.parser import parse_file, parse_mmap
+
+DEFAULT_HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.jsonl")
+LACING_MODES = ("none", "xiph", "ebml", "fixed")
+
+
+def best_time(function, repeat):
+    """Returns the best wall-clock time of repeat calls, in seconds"""
+    times = []
+    for _ in range(repeat):
+        t = time.time()
+        function()
+        times.append(time.time() - t)
+    return min(times)
+
+def git_revision():
+    try:
+        with open(os.devnull, "w") as devnull:
+            output = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=devnull,
+                                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.decode("ascii").strip()
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+
+def run_solver_stages(args, results):
+    ref_subs = make_subtitles(duration=args.minutes*60*1000, lines_per_minute=args.density, seed=args.seed)
+    subs = make_retimed(ref_subs, shift=12345, seed=args.seed)
+    ref_clusters = list(get_clusters(ref_subs))
+    clusters = list(get_clusters(subs))
+    unit = args.unit
+
+    ref_timings = Timings.from_subs(ref_subs)
+    results["get_clusters"] = best_time(lambda: list(get_clusters(ref_subs)), args.repeat)
+    results["get_clusters_timings"] = best_time(lambda: list(get_clusters(ref_timings)), args.repeat)
+    results["discretize"] = best_time(lambda: discretize(ref_clusters, unit), args.repeat)
+
+    rng = random.Random(args.seed)
+    deltas = [rng.gauss(0, 20000) for _ in range(50)]
+    for name, objective in [("set", set_objective(ref_clusters, clusters, unit)),
+                            ("units", UnitMismatchObjective(ref_clusters, clusters, unit)),
+                            ("intervals", IntervalMismatchObjective(ref_clusters, clusters, unit))]:
+        seconds = best_time(lambda: [objective(delta) for delta in deltas], args.repeat)
+        results["objective_%s" % name] = seconds / len(deltas)
+
+    t0 = 5000
+    decay = annealing_decay(unit, t0, args.iterations)
+    objective = UnitMismatchObjective(ref_clusters, clusters, unit)
+    def anneal():
+        rng = random.Random(args.seed)
+        for _ in simulated_annealing_solver(0, lambda x, t: rng.gauss(x, t), objective, t0, args.iterations, decay, rng=rng):
+            pass
+    results["simulated_annealing_solver"] = best_time(anneal, args.repeat)
+
+    settings = {"unit": unit, "t0": t0, "decay": decay, "iterations": args.iterations, "seed": args.seed}
+    for method in ("annealing", "fft", "pyramid", "piecewise", "drift"):
+        results["solver_%s" % method] = best_time(lambda: list(solver_driver(ref_subs, subs, method=method, **settings)),
+                                                  args.repeat)
+
+def run_parser_stages(args, results, directory):
+    subs = make_subtitles(duration=args.mkv_minutes*60*1000, lines_per_minute=args.density, seed=args.seed)
+
+    for lacing in LACING_MODES:
+        path = os.path.join(directory, "%s.mkv" % lacing)
+        make_mkv(path, subs, audio_lacing=lacing, seed=args.seed)
+        megabytes = os.path.getsize(path) / 2**20
+
+        results["mkvparse_file_%s_mbps" % lacing] = megabytes / best_time(lambda: parse_file(path), args.repeat)
+        results["mkvparse_mmap_%s_mbps" % lacing] = megabytes / best_time(lambda: parse_mmap(path), args.repeat)
+
+    path = os.path.join(directory, "nocues.mkv")
+    make_mkv(path, subs, cues=False, seed=args.seed)
+    results["extract_subtitle_track_cues"] = best_time(lambda: extract_subtitle_track(os.path.join(directory, "xiph.mkv")), args.repeat)
+    results["extract_subtitle_track_scan"] = best_time(lambda: extract_subtitle_track(path), args.repeat)
+
+def load_history(path):
+    history = []
+    if os.path.exists(path):
+        with io.open(path, encoding="utf-8") as fp:
+            for line in fp:
+                if line.strip():
+                    history.append(json.loads(line))
+    return history
+
+def compare(record, previous, threshold):
+    """Prints results next to the previous run with the same parameters, returns names of regressions"""
+    regressions = []
+    for name in sorted(record["results"]):
+        value = record["results"][name]
+        old = previous["results"].get(name) if previous else None
+        higher_is_better = name.endswith("_mbps")
+        line = "%-36s %12.6g" % (name, value)
+
+        if old:
+            change = (value - old) / old
+            line += "  %+7.1f%%" % (100*change)
+            if (change < -threshold) if higher_is_better else (change > threshold):
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Time solver and MKV parser stages on synthetic data and "
+                                                 "append the results to a JSON lines history")
+    parser.add_argument("--minutes", type=int, default=120, help="length of synthetic subtitles")
+    parser.add_argument("--density", type=int, default=12, help="subtitle lines per minute")
+    parser.add_argument("--mkv-minutes", type=int, default=10, help="length of synthetic MKV files")
+    parser.add_argument("--unit", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3, help="take best of this many runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--history", default=DEFAULT_HISTORY)
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown reported as regression")
+    parser.add_argument("--skip-mkv", action="store_true")
+    args = parser.parse_args()
+
+    params = dict((name, getattr(args, name)) for name in ("minutes", "density", "mkv_minutes", "unit", "iterations", "seed"))
+    record = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "results": {},
+    }
+
+    run_solver_stages(args, record["results"])
+    if not args.skip_mkv:
+        directory = tempfile.mkdtemp()
+        try:
+            run_parser_stages(args, record["results"], directory)
+        finally:
+            shutil.rmtree(directory)
+
+    history = load_history(args.history)
+    previous = [old for old in history if old.get("params") == params and old.get("python") == record["python"]]
+    regressions = compare(record, previous[-1] if previous else None, args.threshold)
+
+    with io.open(args.history, "a", encoding="utf-8") as fp:
+        fp.write("%s\n" % json.dumps(record, sort_keys=True))
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
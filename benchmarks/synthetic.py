@@ -0,0 +1,161 @@
+from __future__ import division, unicode_literals
+
+import random
+import struct
+from io import open
+import pysubs2
+
+
+def make_subtitles(duration=2*60*60*1000, lines_per_minute=12, seed=0):
+    """Returns SSAFile with randomly spaced dialogue lines covering roughly duration ms"""
+    rng = random.Random(seed)
+    subs = pysubs2.SSAFile()
+    gap = 60000 / lines_per_minute
+    t = 0
+
+    while t < duration:
+        t += int(rng.expovariate(1 / gap))
+        length = rng.randint(800, 5000)
+        subs.append(pysubs2.SSAEvent(start=t, end=t+length, text="line %d" % len(subs)))
+
+    return subs
+
+def make_retimed(ref_subs, shift=12345, drop=0.1, jitter=150, seed=0):
+    """Returns copy of ref_subs shifted by shift ms, with some lines dropped and ends jittered"""
+    rng = random.Random(seed)
+    subs = pysubs2.SSAFile()
+
+    for line in ref_subs:
+        if rng.random() < drop:
+            continue
+        subs.append(pysubs2.SSAEvent(start=line.start+shift,
+                                     end=line.end+shift+rng.randint(-jitter, jitter),
+                                     text=line.text))
+
+    return subs
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Minimal Matroska writer
+
+def ebml_id(id_):
+    return struct.pack(">I", id_).lstrip(b"\x00")
+
+def ebml_size(size, length=None):
+    if length is None:
+        length = 1
+        while size >= 2**(7*length) - 1:
+            length += 1
+    return struct.pack(">Q", size | (1 << (7*length)))[-length:]
+
+def element(id_, payload):
+    return ebml_id(id_) + ebml_size(len(payload)) + payload
+
+def uint_element(id_, value):
+    return element(id_, struct.pack(">Q", value).lstrip(b"\x00") or b"\x00")
+
+def text_element(id_, value):
+    return element(id_, value.encode("utf-8"))
+
+def block(track, timecode, flags, payload):
+    return ebml_size(track) + struct.pack(">hB", timecode, flags) + payload
+
+def laced_block(track, timecode, frames, lacing):
+    """Returns Block/SimpleBlock payload with frames laced in "xiph", "ebml" or "fixed" mode"""
+    flags = 0x80 | {"xiph": 0x02, "fixed": 0x04, "ebml": 0x06}[lacing]
+    header = struct.pack(">B", len(frames)-1)
+
+    if lacing == "xiph":
+        for frame in frames[:-1]:
+            header += b"\xff" * (len(frame) // 255) + struct.pack(">B", len(frame) % 255)
+    elif lacing == "ebml":
+        header += ebml_size(len(frames[0]))
+        for previous, frame in zip(frames[:-2], frames[1:-1]):
+            diff = len(frame) - len(previous)
+            header += ebml_size(diff + 63, 1) if -63 <= diff <= 63 else ebml_size(diff + 8191, 2)
+
+    return block(track, timecode, flags, header + b"".join(frames))
+
+def make_mkv(path, subs, video_frame_size=2000, fps=24, audio_lacing="xiph", cluster_ms=5000, cues=True, seed=0,
+             extra_subs=()):
+    """
+    Writes MKV with video (track 1), audio (track 2) and S_TEXT/UTF8 subtitle (track 3) of subs,
+    followed by S_TEXT/UTF8 tracks 4, 5... of extra_subs.
+
+    Video frames are SimpleBlocks of video_frame_size bytes, audio is sent every 100 ms as
+    SimpleBlock of 4 frames laced in audio_lacing mode ("xiph", "ebml", "fixed" or "none"),
+    subtitles are BlockGroups with BlockDuration. With cues=True, Cues index keyframes and
+    all subtitle blocks and are referenced from SeekHead.
+    """
+    rng = random.Random(seed)
+    lines = sorted(((line.start, track, line) for track, track_subs in enumerate([subs] + list(extra_subs), 3)
+                    for line in track_subs), key=lambda item: item[:2])
+    duration = (max(line.end for _, _, line in lines) if lines else 0) + 1000
+    frame_ms = 1000 / fps
+
+    info = element(0x1549A966, uint_element(0x2AD7B1, 1000000) + text_element(0x4D80, "benchmarks.synthetic"))
+    tracks = element(0x1654AE6B, b"".join(
+        element(0xAE, uint_element(0xD7, n) + uint_element(0x73C5, n) + uint_element(0x83, type_) + text_element(0x86, codec))
+        for n, type_, codec in [(1, 0x01, "V_MPEG4/ISO/AVC"), (2, 0x02, "A_AAC")] +
+                               [(n, 0x11, "S_TEXT/UTF8") for n in range(3, 4 + len(extra_subs))]))
+
+    clusters = []
+    cue_points = []
+    position = 0 # relative to first cluster
+    i = 0
+    for cluster_start in range(0, duration, cluster_ms):
+        body = uint_element(0xE7, cluster_start)
+        cue_points.append((cluster_start, 1, position))
+        t = 0
+        while t < cluster_ms:
+            tc = int(t)
+            payload = bytes(bytearray(rng.getrandbits(8) for _ in range(16))) + b"\x00" * video_frame_size
+            body += element(0xA3, block(1, tc, 0x80 if tc == 0 else 0, payload))
+
+            if tc % 100 < frame_ms:
+                if audio_lacing == "none":
+                    body += element(0xA3, block(2, tc, 0x80, b"\x01" * 200))
+                elif audio_lacing == "fixed":
+                    body += element(0xA3, laced_block(2, tc, [b"\x01" * 200] * 4, audio_lacing))
+                else:
+                    body += element(0xA3, laced_block(2, tc, [b"\x01" * (200 + 7*k) for k in range(4)], audio_lacing))
+
+            while i < len(lines) and lines[i][0] < cluster_start + t + frame_ms:
+                _, track, line = lines[i]
+                body += element(0xA0, element(0xA1, block(track, line.start - cluster_start, 0, line.text.encode("utf-8"))) +
+                                      uint_element(0x9B, line.end - line.start))
+                cue_points.append((line.start, track, position))
+                i += 1
+            t += frame_ms
+
+        cluster = element(0x1F43B675, body)
+        clusters.append(cluster)
+        position += len(cluster)
+
+    def seek_head(entries):
+        return element(0x114D9B74, b"".join(element(0x4DBB, element(0x53AB, ebml_id(id_)) + uint_element(0x53AC, pos))
+                                            for id_, pos in entries))
+
+    # SeekHead positions are written with 8 bytes, so its size is known before the positions are
+    ids = [0x1549A966, 0x1654AE6B] + ([0x1C53BB6B] if cues else [])
+    seek_head_size = len(seek_head([(id_, 2**56) for id_ in ids]))
+    clusters_offset = seek_head_size + len(info) + len(tracks)
+    cues_data = b""
+    if cues:
+        cues_data = element(0x1C53BB6B, b"".join(
+            element(0xBB, uint_element(0xB3, time) + element(0xB7, uint_element(0xF7, track) +
+                                                                   uint_element(0xF1, clusters_offset + pos)))
+            for time, track, pos in sorted(cue_points)))
+
+    positions = [seek_head_size, seek_head_size + len(info), clusters_offset + position]
+    head = seek_head(list(zip(ids, positions)))
+    padding = seek_head_size - len(head)
+    if padding:
+        head += element(0xEC, b"\x00" * (padding - 2)) # Void, sizes differ by at least 2 bytes
+
+    segment = head + info + tracks + b"".join(clusters) + cues_data
+    ebml = element(0x1A45DFA3, uint_element(0x4286, 1) + uint_element(0x42F7, 1) + uint_element(0x42F2, 4) +
+                               uint_element(0x42F3, 8) + text_element(0x4282, "matroska") +
+                               uint_element(0x4287, 4) + uint_element(0x4285, 2))
+
+    with open(path, "wb") as fp:
+        fp.write(ebml + ebml_id(0x18538067) + ebml_size(len(segment), 8) + segment)
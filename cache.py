@@ -0,0 +1,161 @@
+from __future__ import division, unicode_literals
+
+import errno
+import hashlib
+import os
+import os.path
+import struct
+import tempfile
+from collections import OrderedDict
+import numpy as np
+from timings import Timings
+
+
+def default_cache_directory():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "autosubtitleretimer")
+
+class SubtitleCache(object):
+    """
+    On-disk cache of subtitle timings extracted from MKV files.
+
+    Entries are keyed by path, size, mtime and track number, so a changed file is never
+    served stale. Only start/end times are stored (as little-endian int32 arrays), which is
+    all the retiming needs from a reference. Least recently used entries are evicted when
+    the total size exceeds max_size bytes.
+    """
+    MAGIC = b"ASR2"
+
+    def __init__(self, directory=None, max_size=64*2**20):
+        self.directory = directory or default_cache_directory()
+        self.max_size = max_size
+
+    def entry_path(self, path, track=None):
+        st = os.stat(path)
+        key = "%s\0%d\0%r\0%r" % (os.path.abspath(path), st.st_size, st.st_mtime, track)
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".bin")
+
+    def read_entry(self, entry):
+        """Returns int32 array stored in entry (marking it as recently used) or None"""
+        try:
+            with open(entry, "rb") as fp:
+                data = fp.read()
+        except EnvironmentError:
+            return None
+
+        if data[:4] != self.MAGIC or len(data) < 8 or (len(data) - 8) % 4:
+            return None # not written by this version or damaged
+        count, = struct.unpack("<I", data[4:8])
+        values = np.frombuffer(data, dtype="<i4", offset=8)
+        if len(values) != count:
+            return None
+
+        try:
+            os.utime(entry, None) # mark as recently used
+        except EnvironmentError:
+            pass
+        return values
+
+    def write_entry(self, entry, values):
+        values = np.asarray(values, dtype="<i4")
+        data = self.MAGIC + struct.pack("<I", len(values)) + values.tobytes()
+
+        try:
+            os.makedirs(self.directory)
+        except EnvironmentError as exc:
+            if exc.errno != errno.EEXIST: # created by another process
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        os.rename(tmp_path, entry)
+
+    def get(self, path, track=None):
+        """Returns cached Timings (without text) or None"""
+        times = self.read_entry(self.entry_path(path, track))
+        if times is None or len(times) % 2:
+            return None
+
+        count = len(times) // 2
+        return Timings.from_arrays(times[:count], times[count:])
+
+    def put(self, path, timings, track=None):
+        self.write_entry(self.entry_path(path, track), np.concatenate((timings.starts, timings.ends)))
+        self.evict()
+
+    def get_tracks(self, path):
+        """Returns OrderedDict of track number -> Timings of all tracks stored by put_tracks() or None"""
+        numbers = self.read_entry(self.entry_path(path, "tracks"))
+        if numbers is None:
+            return None
+
+        tracks = OrderedDict()
+        for track in numbers.tolist():
+            tracks[track] = self.get(path, track)
+            if tracks[track] is None:
+                return None
+        return tracks
+
+    def put_tracks(self, path, tracks):
+        """Stores dict of track number -> Timings, with list of the tracks"""
+        for track, subs in tracks.items():
+            self.put(path, subs, track)
+        self.write_entry(self.entry_path(path, "tracks"), list(tracks))
+        self.evict()
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits in max_size"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".bin"):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except EnvironmentError:
+                    continue # evicted by another process
+                entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+            except EnvironmentError:
+                pass
+
+class MemoryCache(object):
+    """
+    Subtitle tracks of recently used MKV files kept in memory (with text) in front of backing
+    cache (eg. SubtitleCache), for long running processes like the retiming server. Has the
+    get_tracks()/put_tracks() interface of SubtitleCache, entries are keyed by path, size and
+    mtime, the least recently used are dropped above max_entries files.
+    """
+    def __init__(self, backing=None, max_entries=32):
+        self.backing = backing
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def key(self, path):
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_size, st.st_mtime
+
+    def get_tracks(self, path):
+        key = self.key(path)
+        tracks = self.entries.pop(key, None)
+        if tracks is None and self.backing is not None:
+            tracks = self.backing.get_tracks(path)
+        if tracks is not None:
+            self.store(key, tracks)
+        return tracks
+
+    def put_tracks(self, path, tracks):
+        self.store(self.key(path), tracks)
+        if self.backing is not None:
+            self.backing.put_tracks(path, tracks)
+
+    def store(self, key, tracks):
+        self.entries.pop(key, None)
+        self.entries[key] = tracks
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
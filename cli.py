@@ -0,0 +1,275 @@
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import glob
+import io
+import json
+import multiprocessing
+import sys
+import traceback
+from algorithms import annealing_decay, StopCondition
+from batch import retime_batch
+from cache import SubtitleCache
+from instrumentation import Stats
+from mkvhandler import probe
+from pipeline import retime, was_written, ENCODING
+from progress import ProgressChannel
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+def read_manifest(path):
+    """
+    Returns list of (ref_path, subs_path) from manifest file, one pair per line,
+    either as JSON object {"ref": ..., "subs": ...} or as tab-separated paths
+    """
+    pairs = []
+    with io.open(path, encoding="utf-8") as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            elif line.startswith("{"):
+                d = json.loads(line)
+                pairs.append((d["ref"], d["subs"]))
+            else:
+                ref_path, subs_path = line.split("\t")
+                pairs.append((ref_path, subs_path))
+    return pairs
+
+def expand_globs(ref_pattern, subs_pattern):
+    """
+    Returns list of (ref_path, subs_path), pairing files matched by the patterns in sorted order.
+    A single reference is paired with every subtitle file.
+    """
+    refs = sorted(glob.glob(ref_pattern))
+    subs = sorted(glob.glob(subs_pattern))
+    if len(refs) == 1:
+        refs = refs * len(subs)
+    if len(refs) != len(subs):
+        raise ValueError("%r matches %d files, but %r matches %d" % (ref_pattern, len(refs), subs_pattern, len(subs)))
+    return list(zip(refs, subs))
+
+def progress_printer(label, stream=sys.stderr):
+    """Returns callback for ProgressChannel that keeps rewriting one status line on stream"""
+    def callback(progress):
+        stream.write("\r%s: step %d, best shift %g ms, mismatch %g (%.1f s)" %
+                     (label, progress.i+1, progress.bestx, progress.bestfx, progress.elapsed))
+        stream.flush()
+    return callback
+
+def run_job(job, cache=None, token=None, progress=None):
+    """
+    Retimes one pair, returns result dict written as JSON line. Long running callers can pass
+    their cache (used unless the job disables caching), token (CancellationToken or alike)
+    and progress (instead of the console progress line).
+    """
+    (ref_path, subs_path, settings, stop_criteria, sample_lines, refine, write_file, use_cache, encoding, profile,
+     show_progress, processes) = job
+    result = {"ref": ref_path, "subs": subs_path}
+    stats = Stats(profile)
+    stop = StopCondition(token=token, **stop_criteria)
+    estimates = []
+    if show_progress and progress is None:
+        progress = ProgressChannel(progress_printer(subs_path), interval=0.2)
+    try:
+        if not use_cache:
+            cache = None
+        elif cache is None:
+            cache = SubtitleCache()
+        delta, error = retime(ref_path, subs_path, settings, write_file, cache=cache, encoding=encoding, stats=stats,
+                              stop=stop, progress=progress, sample_lines=sample_lines, refine=refine,
+                              estimated=lambda x, fx: estimates.append(to_json(x)),
+                              processes=processes)
+        if progress is not None:
+            progress.flush()
+        if show_progress:
+            sys.stderr.write("\n")
+        result.update(shift=to_json(delta), mismatch=error, written=was_written(write_file, stop), stop_reason=stop.reason)
+        if estimates:
+            result["estimate"] = estimates[0]
+    except Exception:
+        result["failed"] = traceback.format_exc()
+    result["stats"] = stats.report()
+    return result
+
+def job_result(job):
+    """Returns result dict like run_job does of batch.BatchJob"""
+    result = {"ref": job.ref_path, "subs": job.subs_path}
+    if job.failed is None:
+        result.update(shift=to_json(job.delta), mismatch=job.error, written=job.written, stop_reason=job.stop.reason)
+        if job.estimate is not None:
+            result["estimate"] = to_json(job.estimate)
+    else:
+        result["failed"] = job.failed
+    result["stats"] = job.stats.report()
+    return result
+
+def to_json(delta):
+    return delta.to_json() if hasattr(delta, "to_json") else delta
+
+def solver_settings(args):
+    """Returns (settings for solver_driver, StopCondition arguments) from parsed arguments"""
+    t0 = int(args.step * 1000)
+    settings = {
+        "unit": args.unit,
+        "t0": t0,
+        "decay": annealing_decay(args.unit, t0, args.iterations),
+        "iterations": args.iterations,
+        "method": args.method,
+        "objective": args.objective,
+        "chains": args.chains,
+        "seed": args.seed,
+    }
+    patience = args.iterations // 4 if args.patience is None else args.patience
+    stop_criteria = {
+        "patience": patience or None,
+        "min_temperature": args.unit,
+        "target": args.target,
+        "time_limit": args.time_limit,
+    }
+    return settings, stop_criteria
+
+def probe_files(paths, output_path=None):
+    """Writes JSON line with mkvhandler.probe() of each MKV file, returns exit code"""
+    output = io.open(output_path, "w", encoding="utf-8") if output_path else sys.stdout
+    failed = 0
+    try:
+        for path in paths:
+            result = {"path": path}
+            try:
+                result.update(probe(path))
+            except Exception:
+                result["failed"] = traceback.format_exc()
+                failed += 1
+            output.write("%s\n" % json.dumps(result, sort_keys=True))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 1 if failed else 0
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Retime subtitles against reference subtitles or MKV files, "
+                                                 "writing one JSON line per pair")
+    inputs = parser.add_argument_group("input")
+    inputs.add_argument("--pair", nargs=2, action="append", default=[], metavar=("REF", "SUBS"),
+                        help="reference (subtitles or MKV) and subtitles to be retimed, can be repeated")
+    inputs.add_argument("--ref", metavar="GLOB", help="glob of references, paired with --subs in sorted order")
+    inputs.add_argument("--subs", metavar="GLOB", help="glob of subtitles to be retimed")
+    inputs.add_argument("--manifest", action="append", default=[],
+                        help="file with one pair per line (tab-separated or JSON with \"ref\" and \"subs\")")
+    inputs.add_argument("--probe", action="append", default=[], metavar="MKV",
+                        help="only print duration and tracks of MKV files as JSON lines, can be repeated")
+
+    parser.add_argument("-w", "--write", action="store_true", help="shift and save the subtitles (default is dry run)")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes (with one pair, processes parsing a large MKV reference)")
+    parser.add_argument("-o", "--output", help="write JSON lines to this file instead of stdout")
+    parser.add_argument("--encoding", default=ENCODING)
+    parser.add_argument("--no-cache", action="store_true", help="don't use cache of extracted MKV subtitles")
+    parser.add_argument("--progress", action="store_true",
+                        help="show solver progress on stderr (number of finished pairs with more of them)")
+    parser.add_argument("--profile", action="store_true", help="include cProfile statistics in \"stats\" of each pair")
+
+    staged = parser.add_argument_group("pipeline", "with --jobs 1, pairs are loaded, solved and saved in stages "
+                                                   "running at the same time (not with --profile)")
+    staged.add_argument("--loaders", type=int, default=1, help="threads loading subtitles and extracting references")
+    staged.add_argument("--writers", type=int, default=1, help="threads saving retimed subtitles")
+    staged.add_argument("--prefetch", type=int, default=2, help="pairs waiting between stages")
+    staged.add_argument("--stage-stats", action="store_true", help="print stage utilization as JSON to stderr")
+
+    solver = parser.add_argument_group("solver")
+    solver.add_argument("--method", default="annealing", choices=["annealing", "fft", "pyramid", "piecewise", "drift"])
+    solver.add_argument("--objective", default="units", choices=["units", "intervals"])
+    solver.add_argument("--unit", type=int, default=100, help="precision in ms")
+    solver.add_argument("--step", type=float, default=5, help="initial annealing step size in s")
+    solver.add_argument("--iterations", type=int, default=400)
+    solver.add_argument("--chains", type=int, default=1, help="parallel annealing chains (needs --jobs 1 with more pairs)")
+    solver.add_argument("--seed", type=int)
+
+    solver.add_argument("--sample", type=int, metavar="LINES",
+                        help="quick estimate from about this many lines sampled from MKV references")
+    solver.add_argument("--refine", action="store_true",
+                        help="refine the --sample estimate on all lines (reported as \"estimate\")")
+
+    stopping = parser.add_argument_group("early stopping")
+    stopping.add_argument("--patience", type=int,
+                          help="stop annealing after this many iterations without improvement "
+                               "(default is a quarter of --iterations, 0 disables)")
+    stopping.add_argument("--target", type=float, help="stop annealing once mismatch is at most this")
+    stopping.add_argument("--time-limit", type=float, metavar="SECONDS", help="time budget of each pair")
+    return parser
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    if args.probe:
+        return probe_files(args.probe, args.output)
+
+    pairs = [tuple(pair) for pair in args.pair]
+    for path in args.manifest:
+        pairs.extend(read_manifest(path))
+    if args.ref or args.subs:
+        if not (args.ref and args.subs):
+            parser.error("--ref and --subs must be given together")
+        try:
+            pairs.extend(expand_globs(args.ref, args.subs))
+        except ValueError as exc:
+            parser.error(str(exc))
+    if not pairs:
+        parser.error("no input, use --pair, --ref/--subs or --manifest")
+
+    settings, stop_criteria = solver_settings(args)
+    parallel = args.jobs > 1 and len(pairs) > 1
+    if args.chains > 1 and parallel:
+        parser.error("--chains > 1 runs its own process pool, use it with --jobs 1 or one pair")
+    staged = not parallel and len(pairs) > 1 and not args.profile
+    count_progress = args.progress and (parallel or staged)
+    jobs = [(ref_path, subs_path, settings, stop_criteria, args.sample, args.refine, args.write, not args.no_cache,
+             args.encoding, args.profile, args.progress and not count_progress, 1 if parallel else args.jobs)
+            for ref_path, subs_path in pairs]
+
+    output = io.open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    failed = 0
+    utilization = {}
+    try:
+        if parallel:
+            pool = multiprocessing.Pool(min(args.jobs, len(jobs)))
+            results = pool.imap_unordered(run_job, jobs)
+        elif staged:
+            pool = None
+            batch = retime_batch(pairs, settings, args.write, None if args.no_cache else SubtitleCache(),
+                                 args.encoding, stop_criteria, args.sample, args.refine, args.jobs,
+                                 loaders=args.loaders, writers=args.writers, prefetch=args.prefetch,
+                                 utilization=utilization)
+            results = (job_result(job) for job in batch)
+        else:
+            pool = None
+            results = (run_job(job) for job in jobs)
+
+        for finished, result in enumerate(results, 1):
+            failed += "failed" in result
+            output.write("%s\n" % json.dumps(result, sort_keys=True))
+            output.flush()
+            if count_progress:
+                sys.stderr.write("\r%d/%d pairs done" % (finished, len(jobs)))
+                sys.stderr.flush()
+
+        if count_progress:
+            sys.stderr.write("\n")
+        if args.stage_stats and utilization:
+            sys.stderr.write("%s\n" % json.dumps(utilization))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    return 1 if failed else 0
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    sys.exit(main())
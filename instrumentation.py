@@ -0,0 +1,80 @@
+from __future__ import division, unicode_literals
+
+import cProfile
+import io
+import pstats
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+STAGES = ("load", "extract", "cluster", "solve", "save")
+
+
+class Stats(object):
+    """
+    Stage timers and counters collected during one retime.
+
+    Stages are timed with time.time() around whole steps and counters are plain integers
+    added to once per step (solvers and parsers count locally and report at the end), so
+    the overhead does not depend on number of iterations or blocks. With profile=True,
+    everything run under profiling() is also recorded by cProfile.
+    """
+    def __init__(self, profile=False):
+        self.timers = OrderedDict()
+        self.counters = OrderedDict()
+        self.profiler = cProfile.Profile() if profile else None
+
+    def add_time(self, name, seconds):
+        self.timers[name] = self.timers.get(name, 0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - t)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, counters):
+        """Adds counters collected elsewhere (eg. in a worker process)"""
+        for name, n in counters.items():
+            self.count(name, n)
+
+    @contextmanager
+    def profiling(self):
+        if self.profiler is None:
+            yield
+            return
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+
+    def profile_text(self, limit=25):
+        """Returns cProfile statistics sorted by cumulative time, or None without profiling"""
+        if self.profiler is None:
+            return None
+        stream = io.StringIO() if str is not bytes else io.BytesIO()
+        pstats.Stats(self.profiler, stream=stream).sort_stats("cumulative").print_stats(limit)
+        return stream.getvalue()
+
+    def report(self):
+        """Returns dict with stage times in seconds, counters and profile (if enabled)"""
+        report = {
+            "stages": dict(self.timers),
+            "counters": dict(self.counters),
+            "total": sum(self.timers.values()),
+        }
+        if self.profiler is not None:
+            report["profile"] = self.profile_text()
+        return report
+
+    def summary(self):
+        """Returns one-line human readable summary of stage times and counters"""
+        stages = ["%s %.3f s" % (name, self.timers[name]) for name in STAGES if name in self.timers]
+        counters = ["%s %d" % (name.replace("_", " "), n) for name, n in self.counters.items()]
+        return ", ".join(stages + counters)
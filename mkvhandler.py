@@ -1,23 +1,61 @@
+import logging
 import mkvparse
+import mmap
+import multiprocessing
+from collections import OrderedDict
 from io import open
-import pysubs2
+from timings import Timings
+
+SEGMENT_ID = 0x18538067
+SEEKHEAD_ID = 0x114D9B74
+CLUSTER_ID = 0x1F43B675
+CUES_ID = 0x1C53BB6B
+CLUSTER_ID_BYTES = b"\x1F\x43\xB6\x75"
+
+# smaller files are extracted in one process, pool start-up would take longer than parsing
+PARALLEL_MIN_BYTES = 64 << 20
+RANGES_PER_PROCESS = 4
+
+logger = logging.getLogger(__name__)
 
 
 class SubtitleHandler(mkvparse.MatroskaHandler):
-    def __init__(self):
-        self.subtitle_track = None
-        self.subs = pysubs2.SSAFile()
+    """
+    Collects all text subtitle tracks into subtitle_tracks (track number -> Timings, in file order)
+
+    With sample_lines, only about that many lines per track are collected: every n-th cluster
+    from Cues is parsed so the sample spans the whole file, or without Cues parsing stops
+    once some track has sample_lines lines.
+
+    With only_clusters (sorted offsets), just those clusters are parsed regardless of Cues,
+    which is how extract_subtitle_tracks gives each worker process its range of the file.
+    """
+    def __init__(self, cue_clusters=None, sample_lines=None, only_clusters=None):
+        self.subtitle_tracks = OrderedDict()
         self.timecode_scale = None
+        self.cue_clusters = cue_clusters or {}
+        self.sample_lines = sample_lines
+        self.only_clusters = only_clusters
+        self.stop_after = None
 
     def tracks_available(self):
-        for k in self.tracks:
+        for k in sorted(self.tracks):
             t=self.tracks[k]
             if t["CodecID"][1].startswith("S_TEXT"):
-                self.subtitle_track = k
-                break
-        else:
+                self.subtitle_tracks[k] = Timings()
+        if not self.subtitle_tracks:
             raise RuntimeError("No subtitle track in MKV file")
 
+        self.subscribed_tracks = set(self.subtitle_tracks)
+        if self.only_clusters is not None:
+            self.cluster_positions = self.only_clusters
+        elif all(k in self.cue_clusters for k in self.subtitle_tracks):
+            self.cluster_positions = sorted(set(p for k in self.subtitle_tracks for p in self.cue_clusters[k]))
+            if self.sample_lines:
+                self.cluster_positions = self.cluster_positions[::max(1, len(self.cluster_positions) // self.sample_lines)]
+        else:
+            self.stop_after = self.sample_lines
+
     def segment_info_available(self):
         for (k,(t_,v)) in self.segment_info:
             if k == "TimecodeScale":
@@ -25,19 +63,310 @@ class SubtitleHandler(mkvparse.MatroskaHandler):
                 break
 
     def frame(self, track_id, timestamp, data, more_laced_frames, duration, keyframe, invisible, discardable):
-        if track_id != self.subtitle_track:
+        timings = self.subtitle_tracks.get(track_id)
+        if timings is None:
             return
 
-        ev = pysubs2.SSAEvent(start=int(self.timecode_scale*timestamp),
-                              end=int(self.timecode_scale*(timestamp+duration)),
-                              text=data.decode("utf-8"))
-        self.subs.append(ev)
+        timings.append(int(round(self.timecode_scale*timestamp)),
+                       int(round(self.timecode_scale*(timestamp+duration))),
+                       memoryview(data).tobytes())
+        if self.stop_after and len(timings) >= self.stop_after:
+            self.finished = True
+
+
+def find_segment(source):
+    """Returns mkvparse.EbmlElement of the first Segment in source (file object or buffer) or None"""
+    for element in mkvparse.iter_elements(source):
+        if element.id == SEGMENT_ID:
+            return element
+    return None
+
+def element_at(source, offset):
+    """Returns mkvparse.EbmlElement starting at offset or None"""
+    return next(mkvparse.iter_elements(source, offset), None)
 
+def read_seek_head(source):
+    """
+    Returns (segment data offset, dict of element ID -> absolute offset) from SeekHead
+    of the first Segment, following SeekHeads referenced from it
+    """
+    segment = find_segment(source)
+    if segment is None:
+        return None, {}
 
-def extract_subtitle_track(path_to_mkv):
-    """Returns SSAFile of first subtitle track in MKV file or raises RuntimeError"""
-    handler = SubtitleHandler()
+    offsets = {}
+    pending = [segment.data_offset]
+    while pending:
+        for element in mkvparse.iter_elements(source, pending.pop(), segment.end):
+            if element.id in (SEEKHEAD_ID, CLUSTER_ID): # skip Void, CRC-32 etc.
+                break
+        else:
+            continue
+        if element.id != SEEKHEAD_ID:
+            continue
+
+        for seek in element.children():
+            if seek.name != "Seek":
+                continue
+            d = dict((child.name, child) for child in seek.children())
+            if "SeekID" not in d or "SeekPosition" not in d:
+                continue
+            seek_id = d["SeekID"].value()
+            (seek_id, _) = mkvparse.parse_fixedlength_number(seek_id, 0, len(seek_id))
+            position = segment.data_offset + d["SeekPosition"].value()
+            if seek_id == SEEKHEAD_ID and seek_id not in offsets:
+                pending.append(position)
+            offsets.setdefault(seek_id, position)
+
+    return segment.data_offset, offsets
+
+def read_cue_clusters(source):
+    """
+    Returns dict of track number -> sorted absolute offsets of clusters with cue points
+    of that track, read from Cues found through SeekHead. Empty dict if there is no index.
+    Only CueTrack and CueClusterPosition are decoded, source can be a file object or buffer.
+    """
+    segment_offset, offsets = read_seek_head(source)
+    if CUES_ID not in offsets:
+        return {}
+
+    cues = element_at(source, offsets[CUES_ID])
+    if cues is None or cues.id != CUES_ID:
+        return {}
+
+    clusters = {}
+    for cue_point in cues.children():
+        if cue_point.name != "CuePoint":
+            continue
+        for positions in cue_point.children():
+            if positions.name != "CueTrackPositions":
+                continue
+            d = dict((child.name, child) for child in positions.children()
+                     if child.name in ("CueTrack", "CueClusterPosition"))
+            if "CueTrack" in d and "CueClusterPosition" in d:
+                clusters.setdefault(d["CueTrack"].value(), set()).add(segment_offset + d["CueClusterPosition"].value())
+
+    return dict((track, sorted(positions)) for track, positions in clusters.items())
+
+def scan_clusters(data, pos, end):
+    """
+    Returns sorted offsets of Cluster headers in data[pos:end] found by searching for the Cluster ID,
+    keeping only those which are the first one or where a preceding candidate ends. A false match
+    in block data would have to look like a valid header (see mkvparse.parse_sync_header) and be
+    exactly at the end of another one, so this gives real cluster boundaries to split the file at.
+    """
+    first = None
+    ends = set()
+    positions = []
+    pos = data.find(CLUSTER_ID_BYTES, pos, end)
+    while pos != -1:
+        header = mkvparse.parse_sync_header(data, pos)
+        if header is not None:
+            (_id, size, hsize) = header
+            if first is None or pos in ends:
+                positions.append(pos)
+            first = pos if first is None else first
+            if size != -1:
+                ends.add(pos + hsize + size)
+        pos = data.find(CLUSTER_ID_BYTES, pos + 1, end)
+    return positions
+
+def split_ranges(positions, parts):
+    """Returns positions split to at most parts consecutive non-empty lists of about the same length"""
+    parts = max(1, min(parts, len(positions)))
+    bounds = [len(positions) * i // parts for i in range(parts + 1)]
+    return [positions[a:b] for a, b in zip(bounds, bounds[1:])]
+
+def _extract_range(args):
+    """Pool worker: returns (subtitle tracks, parser counters) of clusters starting at positions"""
+    (path_to_mkv, positions, first_cluster) = args
+    handler = SubtitleHandler(only_clusters=positions)
     with open(path_to_mkv, "rb") as fp:
-        mkvparse.mkvparse(fp, handler)
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            mkvparse.mkvparse_buffer(data, handler)
+        finally:
+            close_mapping(data)
+    # jump from the first cluster to this range is not really skipped, other workers parse it
+    counters = {
+        "bytes_parsed": handler.bytes_parsed,
+        "bytes_skipped": handler.bytes_skipped - (positions[0] - first_cluster),
+        "bytes_resynced": handler.bytes_resynced,
+    }
+    return handler.subtitle_tracks, counters
+
+def extract_parallel(path_to_mkv, data, cue_clusters, processes=None):
+    """
+    Returns (subtitle tracks, parser counters) like SubtitleHandler after parsing data, but with
+    clusters split into ranges parsed in a pool of processes, or None if the file is not worth it
+    or can't be split (eg. clusters of unknown size without Cues).
+
+    Ranges start at cluster offsets from Cues (of subtitle clusters, same as the serial parser
+    reads) or from scan_clusters(). Each worker parses the header and its clusters, results are
+    concatenated in range order, which is the order of cluster timestamps.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    if processes < 2 or len(data) < PARALLEL_MIN_BYTES:
+        return None
+
+    segment = find_segment(data)
+    if segment is None:
+        return None
+    first_cluster = next((element.offset for element in segment.children() if element.id == CLUSTER_ID), None)
+    if first_cluster is None:
+        return None
+
+    header = SubtitleHandler(cue_clusters)
+    mkvparse.mkvparse_buffer(data, header, 0, first_cluster) # calls tracks_available
+    if header.cluster_positions is not None:
+        positions = [p for p in header.cluster_positions if p >= first_cluster]
+    else:
+        positions = scan_clusters(data, first_cluster, segment.end)
+    if len(positions) < 2:
+        return None
+
+    ranges = split_ranges(positions, processes * RANGES_PER_PROCESS)
+    pool = multiprocessing.Pool(min(processes, len(ranges)))
+    try:
+        results = pool.map(_extract_range, [(path_to_mkv, r, first_cluster) for r in ranges])
+    finally:
+        pool.close()
+        pool.join()
+
+    tracks = header.subtitle_tracks
+    counters = dict((name, 0) for name in ("bytes_parsed", "bytes_skipped", "bytes_resynced"))
+    for range_tracks, range_counters in results:
+        for track, timings in range_tracks.items():
+            tracks[track].extend(timings)
+        for name, n in range_counters.items():
+            counters[name] += n
+    return tracks, counters
+
+def probe(path_to_mkv):
+    """
+    Returns dict with "duration" (ms, or None), "timecode_scale" (ns) and "tracks", list of dicts
+    with "number", "type", "codec", "language" and "name" of each track. Only Info and Tracks
+    are read, parsing stops at the first Cluster.
+    """
+    info = {"duration": None, "timecode_scale": 1000000, "tracks": []}
+    track_types = {1: "video", 2: "audio", 0x11: "subtitle"}
+    with open(path_to_mkv, "rb") as fp:
+        segment = find_segment(fp)
+        if segment is None:
+            raise RuntimeError("No Segment in MKV file")
+
+        duration = None
+        for element in segment.children():
+            if element.id == CLUSTER_ID:
+                break
+            elif element.name == "Info":
+                for child in element.children():
+                    if child.name == "TimecodeScale":
+                        info["timecode_scale"] = child.value()
+                    elif child.name == "Duration":
+                        duration = child.value()
+            elif element.name == "Tracks":
+                for entry in element.children():
+                    if entry.name != "TrackEntry":
+                        continue
+                    d = dict((child.name, child) for child in entry.children())
+                    value = lambda name, default=None: d[name].value() if name in d else default
+                    info["tracks"].append({
+                        "number": value("TrackNumber"),
+                        "type": track_types.get(value("TrackType"), value("TrackType")),
+                        "codec": value("CodecID"),
+                        "language": value("Language", "eng"),
+                        "name": value("Name"),
+                    })
+
+    if duration is not None:
+        info["duration"] = int(round(duration * info["timecode_scale"] / 1000000))
+    return info
+
+
+def close_mapping(data):
+    """
+    Closes mmap of the file. If parsing raised, frames of the traceback still hold memoryviews
+    of it and close() fails with BufferError, which would replace the original error. The mapping
+    is then left to be closed when they are freed.
+    """
+    try:
+        data.close()
+    except BufferError:
+        pass
+
+def extract_subtitle_tracks(path_to_mkv, cache=None, stats=None, sample_lines=None, processes=1):
+    """
+    Returns OrderedDict of track number -> Timings of all text subtitle tracks in MKV file,
+    read in one pass, or raises RuntimeError if there are none. Text is kept undecoded,
+    use Timings.to_subs() to get SSAFile.
+
+    If Cues index all subtitle tracks, only clusters with their cue points are parsed,
+    otherwise the whole file is scanned. With cache (SubtitleCache), timings of a file
+    that was extracted before are returned without parsing it. Parser counters are added
+    to stats (instrumentation.Stats), if given.
+
+    With sample_lines, only a sample of about that many lines per track is extracted
+    for a quick estimate (see SubtitleHandler), which is not cached.
+
+    With processes other than 1 (None for number of CPUs), large files are split into cluster
+    ranges parsed in a process pool (see extract_parallel). Can't be used in daemonic processes,
+    like workers of another multiprocessing.Pool.
+    """
+    if cache is not None:
+        tracks = cache.get_tracks(path_to_mkv)
+        if tracks is not None:
+            if stats is not None:
+                stats.count("cache_hits")
+            return tracks
+
+    with open(path_to_mkv, "rb") as fp:
+        try:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError): # empty file or not mappable
+            data = None
+
+        try:
+            try:
+                cue_clusters = read_cue_clusters(fp if data is None else data)
+            except Exception:
+                cue_clusters = {} # damaged or unusual index, do a full scan
+
+            result = None
+            if data is not None and not sample_lines and processes != 1:
+                result = extract_parallel(path_to_mkv, data, cue_clusters, processes)
+
+            if result is None:
+                handler = SubtitleHandler(cue_clusters, sample_lines)
+                if data is None:
+                    fp.seek(0)
+                    mkvparse.mkvparse(fp, handler)
+                else:
+                    mkvparse.mkvparse_buffer(data, handler)
+                result = (handler.subtitle_tracks, {
+                    "bytes_parsed": handler.bytes_parsed,
+                    "bytes_skipped": handler.bytes_skipped,
+                    "bytes_resynced": handler.bytes_resynced,
+                })
+        finally:
+            if data is not None:
+                close_mapping(data)
+
+    (tracks, counters) = result
+    if not tracks:
+        raise RuntimeError("No subtitle track in MKV file")
+    if stats is not None:
+        for name in ("bytes_parsed", "bytes_skipped", "bytes_resynced"):
+            stats.count(name, counters[name])
+    if cache is not None and not sample_lines:
+        try:
+            cache.put_tracks(path_to_mkv, tracks)
+        except Exception:
+            logger.warning("Cannot cache subtitles of %r", path_to_mkv, exc_info=True)
+
+    return tracks
 
-    return handler.subs
+def extract_subtitle_track(path_to_mkv, cache=None, stats=None, processes=1):
+    """Returns Timings of first subtitle track in MKV file or raises RuntimeError"""
+    tracks = extract_subtitle_tracks(path_to_mkv, cache, stats, processes=processes)
+    return tracks[next(iter(tracks))]
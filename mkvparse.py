@@ -3,19 +3,30 @@
 # Simple easy-to-use hacky matroska parser
 
 # Supports SimpleBlock and BlockGroup, lacing, TimecodeScale.
-# Does not support seeking, cues, chapters and other features.
+# Can skip clusters not listed by the handler (see mkvhandler for reading them from Cues).
+# Does not support chapters and other features.
 # No proper EOF handling unfortunately
 
 # See "mkvuser.py" for the example
 
 import traceback
+from bisect import bisect_left
 from struct import unpack
 
 import sys
 
 if sys.version < '3':
     range=xrange
+    from binascii import hexlify
+    def from_bytes(data):
+        return int(hexlify(data), 16) if data else 0
+    def buffer_view(data):
+        return data # mmap has no new-style buffer interface in Python 2
 else:
+    def from_bytes(data):
+        return int.from_bytes(data, "big")
+    def buffer_view(data):
+        return memoryview(data)
     #identity=lambda x:x
     def ord(something):
         if type(something)==bytes:
@@ -35,6 +46,9 @@ def get_major_bit_number(n):
     '''
     if not n:
         raise Exception("Bad number")
+    return major_bit_numbers[n]
+
+def _get_major_bit_number(n):
     i=0x80;
     r=0
     while not n&i:
@@ -42,6 +56,8 @@ def get_major_bit_number(n):
         i>>=1
     return (r,n&~i);
 
+major_bit_numbers = [None] + [_get_major_bit_number(n) for n in range(1, 256)]
+
 def read_matroska_number(f, unmodified=False, signed=False):
     '''
         Read ebml number. Unmodified means don't clear the length bit (as in Element IDs)
@@ -90,16 +106,13 @@ def parse_matroska_number(data, pos, unmodified=False, signed=False):
     if unmodified and signed:
         raise Exception("Contradictary arguments")
     r = ord(data[pos])
-    pos+=1
     (n,r2) = get_major_bit_number(r)
     if not unmodified:
         r=r2
+    if n:
+        r = (r << 8*n) | from_bytes(data[pos+1:pos+n+1])
+    pos+=n+1
     # from now "signed" means "negative"
-    i=n
-    while i:
-        r = r * 0x100 + ord(data[pos])
-        pos+=1
-        i-=1
     if signed:
         r-=(2**(7*n+6)-1)
     else:
@@ -144,9 +157,7 @@ def parse_fixedlength_number(data, pos, length, signed=False):
         "\xFF\x04" -> (0xFF04,  pos+2)
         "\xFF\x04" signed -> (-0x00FC,  pos+2)
     '''
-    r=0
-    for i in range(length):
-        r=r*0x100+ord(data[pos+i])
+    r=from_bytes(data[pos:pos+length])
     if signed:
         if ord(data[pos]) & 0x80:
             r-=2**(8*length)
@@ -159,6 +170,28 @@ def read_fixedlength_number(f, length, signed=False):
     (r, pos) = parse_fixedlength_number(buf, 0, length, signed)
     return r
     
+def skip_bytes(f, length):
+    '''
+        Skip length bytes of f, seeking if the file supports it
+    '''
+    try:
+        f.seek(length, 1)
+    except (AttributeError, IOError, ValueError):
+        f.read(length)
+
+def peek_block_track(f):
+    '''
+        Read the track number at the beginning of Block or SimpleBlock
+        Returns the track number and the bytes read, to be prepended to the rest of the block
+    '''
+    head=f.read(1)
+    if(head==b""):
+        raise StopIteration
+    (n, r) = get_major_bit_number(ord(head))
+    head += f.read(n)
+    (tracknum, pos) = parse_matroska_number(head, 0)
+    return (tracknum, head)
+
 def read_ebml_element_header(f):
     '''
         Read Element ID and size
@@ -446,13 +479,16 @@ def read_simple_element(f, type_, size):
         data=f.read(size)
     return data
 
-def read_ebml_element_tree(f, total_size):
+def read_ebml_element_tree(f, total_size, subscribed_tracks=None):
     '''
         Build tree of elements, reading f until total_size reached
         Don't use for the whole segment, it's not Haskell
 
         Returns list of pairs (element_name, element_value).
         element_value can also be list of pairs
+
+        If subscribed_tracks is given and a Block of other track is found,
+        the rest of the tree is skipped and None is returned
     '''
     childs=[]
     while(total_size>0):
@@ -469,14 +505,188 @@ def read_ebml_element_tree(f, total_size):
         name = "unknown_%x"%id_
         if id_ in element_types_names:
             (type_, name) = element_types_names[id_]
-        data = read_simple_element(f, type_, size)
+        if name=="Block" and subscribed_tracks is not None:
+            (tracknum, head) = peek_block_track(f)
+            if tracknum not in subscribed_tracks:
+                skip_bytes(f, total_size-hsize-len(head))
+                return None
+            data = head + f.read(size-len(head))
+        else:
+            data = read_simple_element(f, type_, size)
         total_size-=(size+hsize)
         childs.append((name, (type_, data))) 
     return childs
                 
 
+def to_bytes(data):
+    '''
+        Copy a buffer slice into bytes (memoryview slices are not bytes)
+    '''
+    return data.tobytes() if isinstance(data, memoryview) else data
+
+def parse_ebml_element_header(data, pos):
+    '''
+        Parse Element ID and size from data[pos:]
+        Returns id, element size and position of the element data
+    '''
+    (id_, pos) = parse_matroska_number(data, pos, unmodified=True)
+    (size, pos) = parse_matroska_number(data, pos)
+    return (id_, size, pos)
+
+def parse_simple_element(data, pos, type_, size):
+    '''
+        Just like read_simple_element, but parses data[pos:pos+size]
+    '''
+    if size==0:
+        return ""
+
+    if type_==EET.UNSIGNED:
+        (data, pos) = parse_fixedlength_number(data, pos, size, False)
+    elif type_==EET.SIGNED:
+        (data, pos) = parse_fixedlength_number(data, pos, size, True)
+    elif type_==EET.TEXTA:
+        data = to_bytes(data[pos:pos+size])
+        data = data.replace(b"\x00", b"")  # filter out \0, for gstreamer
+        data = data.decode("ascii")
+    elif type_==EET.TEXTU:
+        data = to_bytes(data[pos:pos+size])
+        data = data.replace(b"\x00", b"")  # filter out \0, for gstreamer
+        data = data.decode("UTF-8")
+    elif type_==EET.MASTER:
+        data=parse_ebml_element_tree(data, pos, size)
+    elif type_==EET.DATE:
+        (data, pos) = parse_fixedlength_number(data, pos, size, True)
+        data/=1000000000.0;
+        data+=978300000 # 2001-01-01T00:00:00,000000000
+        # now should be UNIX date
+    elif type_==EET.FLOAT:
+        if size==4:
+            data = unpack(">f", to_bytes(data[pos:pos+4]))[0]
+        elif size==8:
+            data = unpack(">d", to_bytes(data[pos:pos+8]))[0]
+        else:
+            sys.stderr.write("mkvparse: Floating point of size %d is not supported\n" % size)
+            data = None
+    else:
+        data = to_bytes(data[pos:pos+size])
+    return data
+
+def parse_ebml_element_tree(data, pos, total_size, subscribed_tracks=None):
+    '''
+        Just like read_ebml_element_tree, but parses data[pos:pos+total_size]
+        Block payloads are left as zero-copy slices of data
+    '''
+    childs=[]
+    end = pos+total_size
+    while(pos<end):
+        (id_, size, data_pos) = parse_ebml_element_header(data, pos)
+        if size == -1 or data_pos+size>end:
+            sys.stderr.write("mkvparse: Element %x with size %d? Damaged data? Skipping %d bytes\n" % (id_, size, end-pos))
+            break
+        type_ = EET.BINARY
+        name = "unknown_%x"%id_
+        if id_ in element_types_names:
+            (type_, name) = element_types_names[id_]
+        if name=="Block":
+            if subscribed_tracks is not None and parse_matroska_number(data, data_pos)[0] not in subscribed_tracks:
+                return None
+            value = data[data_pos:data_pos+size]
+        else:
+            value = parse_simple_element(data, data_pos, type_, size)
+        pos = data_pos+size
+        childs.append((name, (type_, value)))
+    return childs
+
+class EbmlElement(object):
+    '''
+        Element header yielded by iter_elements: id, name, type, offset of the header and offset
+        and size of the data (size is -1 for unknown size). Nothing is decoded until value() or
+        children() is called.
+    '''
+    __slots__ = ("source", "id", "name", "type", "offset", "data_offset", "size", "end")
+
+    def __init__(self, source, id_, offset, data_offset, size, end):
+        self.source = source
+        self.id = id_
+        (self.type, self.name) = element_types_names.get(id_, (EET.BINARY, "unknown_%x" % id_))
+        self.offset = offset
+        self.data_offset = data_offset
+        self.size = size
+        self.end = end
+
+    def value(self):
+        '''
+            Decode data of the element like read_simple_element does (master elements give the
+            whole tree of (name, (type, value)) pairs)
+        '''
+        if hasattr(self.source, "read"):
+            self.source.seek(self.data_offset)
+            return read_simple_element(self.source, self.type, self.end - self.data_offset)
+        elif self.type == EET.MASTER:
+            return parse_ebml_element_tree(self.source, self.data_offset, self.end - self.data_offset)
+        else:
+            return parse_simple_element(self.source, self.data_offset, self.type, self.end - self.data_offset)
+
+    def children(self):
+        '''
+            Iterate child elements (see iter_elements)
+        '''
+        return iter_elements(self.source, self.data_offset, self.end)
+
+    def __repr__(self):
+        return "<EbmlElement %s at %d, size %d>" % (self.name, self.offset, self.size)
+
+def iter_elements(source, pos=0, end=None):
+    '''
+        Iterate elements in source (seekable file object or bytes-like buffer like mmap) from pos
+        to end (end of source by default), yielding EbmlElement for each of them. Subtrees that
+        are not entered by children() are skipped without reading them, so the caller can stop
+        at any point. An element of unknown size extends to end. Stops at truncated or damaged data.
+    '''
+    is_file = hasattr(source, "read")
+    if is_file:
+        if end is None:
+            source.seek(0, 2)
+            end = source.tell()
+    else:
+        source = buffer_view(source)
+        end = len(source) if end is None else end
+
+    while pos < end:
+        try:
+            if is_file:
+                source.seek(pos)
+                (id_, size, hsize) = read_ebml_element_header(source)
+                data_pos = pos + hsize
+            else:
+                (id_, size, data_pos) = parse_ebml_element_header(source, pos)
+        except Exception: # truncated or damaged
+            return
+        element_end = end if size == -1 else min(data_pos + size, end)
+        yield EbmlElement(source, id_, pos, data_pos, size, element_end)
+        pos = element_end
+
 class MatroskaHandler:
     """ User for mkvparse should override these methods """
+
+    # Track numbers to call frame() for. Blocks of other tracks are skipped
+    # without reading their payload. None means all tracks.
+    subscribed_tracks = None
+
+    # Sorted absolute file offsets of Clusters to parse. Other clusters are
+    # skipped by seeking, parsing stops after the last one. None means all clusters.
+    cluster_positions = None
+
+    # Set by the parser: bytes read and decoded, bytes skipped over (unsubscribed
+    # blocks and clusters not in cluster_positions) and bytes of damaged data
+    # skipped by resync.
+    bytes_parsed = 0
+    bytes_skipped = 0
+    bytes_resynced = 0
+
+    # Set to True to stop parsing after the current element.
+    finished = False
+
     def tracks_available(self):
         pass
     def segment_info_available(self):
@@ -508,7 +718,8 @@ def handle_block(buffer, handler, cluster_timecode, timecode_scale=1000000, dura
 
     if laceflags == 0x00: # no lacing
         buf = buffer[pos:]
-        handler.frame(tracknum, block_timecode, header_removal_prefix+buf, 0, duration, f_keyframe, f_invisible, f_discardable)
+        if header_removal_prefix: buf = header_removal_prefix+buf
+        handler.frame(tracknum, block_timecode, buf, 0, duration, f_keyframe, f_invisible, f_discardable)
         return
     
     numframes = ord(buffer[pos]); pos+=1
@@ -544,33 +755,166 @@ def handle_block(buffer, handler, cluster_timecode, timecode_scale=1000000, dura
     for i in lengths:
         buf = buffer[pos:pos+i]
         pos+=i
-        handler.frame(tracknum, block_timecode, header_removal_prefix+buf, more_laced_frames, duration, f_keyframe, f_invisible, f_discardable)
+        if header_removal_prefix: buf = header_removal_prefix+buf
+        handler.frame(tracknum, block_timecode, buf, more_laced_frames, duration, f_keyframe, f_invisible, f_discardable)
         more_laced_frames-=1
 
 
+def handle_block_group(tree, handler, cluster_timecode, timecode_scale, header_removal_headers_for_tracks):
+    '''
+        Decode BlockGroup tree with its BlockDuration
+    '''
+    d = dict(tree)
+    duration=None
+    if 'BlockDuration' in d:
+        duration = d['BlockDuration'][1]
+        duration = duration*0.000000001*timecode_scale
+    if 'Block' in d:
+        handle_block(d['Block'][1], handler, cluster_timecode, timecode_scale, duration, header_removal_headers_for_tracks)
+
+def check_ebml_header(tree):
+    d = dict(tree)
+    if 'EBMLReadVersion' in d:
+        if d['EBMLReadVersion'][1]>1: sys.stderr.write("mkvparse: Warning: EBMLReadVersion too big\n")
+    if 'DocTypeReadVersion' in d:
+        if d['DocTypeReadVersion'][1]>2: sys.stderr.write("mkvparse: Warning: DocTypeReadVersion too big\n")
+    dt = d['DocType'][1]
+    if dt != "matroska" and dt != "webm": 
+        sys.stderr.write("mkvparse: Warning: EBML DocType is not \"matroska\" or \"webm\"")
+
+def handle_segment_info(handler, tree, timecode_scale):
+    '''
+        Pass Info tree to handler, returns the TimecodeScale
+    '''
+    handler.segment_info = tree
+    handler.segment_info_available()
+    
+    d = dict(tree)
+    if "TimecodeScale" in d:
+        timecode_scale = d["TimecodeScale"][1]
+    return timecode_scale
+
+def handle_tracks(handler, tree, header_removal_headers_for_tracks):
+    '''
+        Pass Tracks tree to handler, filling header_removal_headers_for_tracks
+    '''
+    handler.tracks={}
+    for (ten, (_t, track)) in tree:
+        if ten != "TrackEntry": continue
+        d = dict(track)
+        n = d['TrackNumber'][1]
+        handler.tracks[n]=d
+        tt = d['TrackType'][1]
+        if   tt==0x01: d['type']='video'
+        elif tt==0x02: d['type']='audio'
+        elif tt==0x03: d['type']='complex'
+        elif tt==0x10: d['type']='logo'
+        elif tt==0x11: d['type']='subtitle'
+        elif tt==0x12: d['type']='button'
+        elif tt==0x20: d['type']='control'
+        if 'TrackTimecodeScale' in d:
+            sys.stderr.write("mkvparse: Warning: TrackTimecodeScale is not supported\n")
+        if 'ContentEncodings' in d:
+            try:
+                compr = dict(d["ContentEncodings"][1][0][1][1][0][1][1])
+                if compr["ContentCompAlgo"][1] == 3:
+                    header_removal_headers_for_tracks[n] = compr["ContentCompSettings"][1]
+                else:
+                    sys.stderr.write("mkvparse: Warning: compression other than " \
+                        "header removal is not supported\n")
+            except:
+                sys.stderr.write("mkvparse: Warning: unsuccessfully tried " \
+                        "to handle header removal compression\n")
+    handler.tracks_available()
+
+sync_ids = (b"\x1F\x43\xB6\x75", b"\x18\x53\x80\x67", b"\x16\x54\xAE\x6B") # cluster, segment, tracks
+RESYNC_CHUNK = 1 << 20
+SYNC_LOOKAHEAD = 4 + 8 + 4 + 8 # sync ID, its size, first child ID and size
+
+def find_sync_id(data, pos, end=None):
+    '''
+        Returns position of the first Cluster, Segment or Tracks ID in data[pos:end] or -1
+    '''
+    end = len(data) if end is None else end
+    found = [p for p in (data.find(sync_id, pos, end) for sync_id in sync_ids) if p != -1]
+    return min(found) if found else -1
+
+def parse_sync_header(data, pos):
+    '''
+        Validate a candidate header at data[pos:] found by find_sync_id: its size must be a valid number
+        and it must be followed by a known child element that fits in it.
+        Returns (id, size, header size) or None
+    '''
+    try:
+        (id_, size, data_pos) = parse_ebml_element_header(data, pos)
+        (child_id, child_size, child_pos) = parse_ebml_element_header(data, data_pos)
+    except Exception: # bad or truncated number
+        return None
+    if child_id not in element_types_names:
+        return None
+    if size != -1 and child_size != -1 and child_pos + child_size > data_pos + size:
+        return None
+    return (id_, size, data_pos - pos)
+
 def resync(f):
-    sys.stderr.write("mvkparse: Resyncing\n")
+    '''
+        Scan f from the current position for a valid Cluster, Segment or Tracks header, reading it
+        in RESYNC_CHUNK blocks. Returns (id, size, bytes skipped) with f positioned at the element
+        data, or (None, None, bytes skipped) at the end of file.
+    '''
+    start = f.tell()
+    base = start # file position of buf[0]
+    buf = b""
+    pos = 0
+    eof = False
     while True:
-        b = f.read(1);
-        if b == b"": return (None, None);
-        if b == b"\x1F":
-            b2 = f.read(3);
-            if b2 == b"\x43\xB6\x75":
-                (seglen, x) = read_matroska_number(f)
-                return (0x1F43B675, seglen) # cluster
-        if b == b"\x18":
-            b2 = f.read(3)
-            if b2 == b"\x53\x80\x67":
-                (seglen, x) = read_matroska_number(f)
-                return (0x18538067, seglen) # segment
-        if b == b"\x16":
-            b2 = f.read(3)
-            if b2 == b"\x54\xAE\x6B":
-                (seglen ,x )= read_matroska_number(f)
-                return (0x1654AE6B, seglen) # tracks
-                
-                
-    
+        candidate = find_sync_id(buf, pos)
+        if candidate == -1 or (len(buf) - candidate < SYNC_LOOKAHEAD and not eof):
+            if eof:
+                sys.stderr.write("mkvparse: Resync found nothing in %d bytes\n" % (base + len(buf) - start))
+                return (None, None, base + len(buf) - start)
+            keep = candidate if candidate != -1 else max(pos, len(buf) - 3) # ID may span the chunks
+            chunk = f.read(RESYNC_CHUNK)
+            eof = not chunk
+            base += keep
+            buf = buf[keep:] + chunk
+            pos = 0
+            continue
+
+        header = parse_sync_header(buf, candidate)
+        if header is None:
+            pos = candidate + 1
+            continue
+
+        (id_, size, hsize) = header
+        skipped = base + candidate - start
+        sys.stderr.write("mkvparse: Resynced at element %x, skipped %d bytes\n" % (id_, skipped))
+        f.seek(base + candidate + hsize)
+        return (id_, size, skipped)
+
+def resync_buffer(data, pos, end=None):
+    '''
+        Find the next valid Cluster, Segment or Tracks header in data[pos:end], searching windows
+        of RESYNC_CHUNK bytes (Segment and Tracks IDs usually don't occur again, a search
+        to end would scan the rest of the file for them)
+        Returns its position or None
+    '''
+    start = pos
+    end = len(data) if end is None else end
+    while pos < end:
+        window_end = min(pos + RESYNC_CHUNK, end)
+        candidate = find_sync_id(data, pos, window_end)
+        if candidate == -1:
+            if window_end == end:
+                break
+            pos = max(pos + 1, window_end - 3) # ID may span the windows
+        elif parse_sync_header(data, candidate) is not None:
+            sys.stderr.write("mkvparse: Resynced, skipped %d bytes\n" % (candidate - start))
+            return candidate
+        else:
+            pos = candidate + 1
+    sys.stderr.write("mkvparse: Resync found nothing in %d bytes\n" % (end - start))
+    return None
 
 def mkvparse(f, handler):
     '''
@@ -582,6 +926,9 @@ def mkvparse(f, handler):
     resync_element_id = None
     resync_element_size = None
     header_removal_headers_for_tracks = {}
+    handler.bytes_skipped = 0
+    handler.bytes_resynced = 0
+    start_position = f.tell()
     while f:
         (id_, size, hsize) = (None, None, None)
         tree = None
@@ -595,7 +942,8 @@ def mkvparse(f, handler):
                     break;
                 if not (id_ in element_types_names): 
                     sys.stderr.write("mkvparse: Unknown element with id %x and size %d\n"%(id_, size))
-                    (resync_element_id, resync_element_size) = resync(f)
+                    (resync_element_id, resync_element_size, skipped) = resync(f)
+                    handler.bytes_resynced += skipped
                     if resync_element_id:
                         continue;
                     else:
@@ -609,84 +957,154 @@ def mkvparse(f, handler):
             (type_, name) = element_types_names[id_]
 
             if type_==EET.MASTER:
-                tree = read_ebml_element_tree(f, size)
+                subscribed_tracks = handler.subscribed_tracks if name=="BlockGroup" else None
+                tree = read_ebml_element_tree(f, size, subscribed_tracks)
                 data = tree
+            elif name=="Cluster" and handler.cluster_positions is not None and hsize is not None:
+                # jump to the next cluster the handler asked for, stop after the last one
+                position = f.tell() - hsize
+                i = bisect_left(handler.cluster_positions, position)
+                if i == len(handler.cluster_positions):
+                    break
+                if handler.cluster_positions[i] != position:
+                    handler.bytes_skipped += handler.cluster_positions[i] - position
+                    f.seek(handler.cluster_positions[i])
+                    continue
             elif type_==EET.JUST_GO_ON:
                 pass
         except Exception:
             traceback.print_exc()
-            (resync_element_id, resync_element_size) = resync(f)
+            (resync_element_id, resync_element_size, skipped) = resync(f)
+            handler.bytes_resynced += skipped
             if resync_element_id:
                 continue;
             else:
                 break;
         
         if name=="EBML":
-            d = dict(tree)
-            if 'EBMLReadVersion' in d:
-                if d['EBMLReadVersion'][1]>1: sys.stderr.write("mkvparse: Warning: EBMLReadVersion too big\n")
-            if 'DocTypeReadVersion' in d:
-                if d['DocTypeReadVersion'][1]>2: sys.stderr.write("mkvparse: Warning: DocTypeReadVersion too big\n")
-            dt = d['DocType'][1]
-            if dt != "matroska" and dt != "webm": 
-                sys.stderr.write("mkvparse: Warning: EBML DocType is not \"matroska\" or \"webm\"")
+            check_ebml_header(tree)
         elif name=="Info":
-            handler.segment_info = tree
-            handler.segment_info_available()
-            
-            d = dict(tree)
-            if "TimecodeScale" in d:
-                timecode_scale = d["TimecodeScale"][1]
+            timecode_scale = handle_segment_info(handler, tree, timecode_scale)
         elif name=="Tracks":
-            handler.tracks={}
-            for (ten, (_t, track)) in tree:
-                if ten != "TrackEntry": continue
-                d = dict(track)
-                n = d['TrackNumber'][1]
-                handler.tracks[n]=d
-                tt = d['TrackType'][1]
-                if   tt==0x01: d['type']='video'
-                elif tt==0x02: d['type']='audio'
-                elif tt==0x03: d['type']='complex'
-                elif tt==0x10: d['type']='logo'
-                elif tt==0x11: d['type']='subtitle'
-                elif tt==0x12: d['type']='button'
-                elif tt==0x20: d['type']='control'
-                if 'TrackTimecodeScale' in d:
-                    sys.stderr.write("mkvparse: Warning: TrackTimecodeScale is not supported\n")
-                if 'ContentEncodings' in d:
-                    try:
-                        compr = dict(d["ContentEncodings"][1][0][1][1][0][1][1])
-                        if compr["ContentCompAlgo"][1] == 3:
-                            header_removal_headers_for_tracks[n] = compr["ContentCompSettings"][1]
-                        else:
-                            sys.stderr.write("mkvparse: Warning: compression other than " \
-                                "header removal is not supported\n")
-                    except:
-                        sys.stderr.write("mkvparse: Warning: unsuccessfully tried " \
-                                "to handle header removal compression\n")
-            handler.tracks_available()
+            handle_tracks(handler, tree, header_removal_headers_for_tracks)
         # cluster contents:
         elif name=="Timecode":
             data=read_fixedlength_number(f, size, False)
             current_cluster_timecode = data;
         elif name=="SimpleBlock":
-            data=f.read(size)
-            handle_block(data, handler, current_cluster_timecode, timecode_scale, None,  header_removal_headers_for_tracks)
+            if handler.subscribed_tracks is None:
+                data=f.read(size)
+            else:
+                try:
+                    (tracknum, head) = peek_block_track(f)
+                except StopIteration:
+                    break # file truncated in block header
+                if tracknum in handler.subscribed_tracks:
+                    data = head + f.read(size-len(head))
+                else:
+                    skip_bytes(f, size-len(head))
+                    handler.bytes_skipped += size-len(head)
+            if data is not None:
+                handle_block(data, handler, current_cluster_timecode, timecode_scale, None,  header_removal_headers_for_tracks)
+        elif name=="BlockGroup" and tree is None:
+            handler.bytes_skipped += size # block of unsubscribed track
         elif name=="BlockGroup":
-            d2 = dict(tree)
-            duration=None
-            if 'BlockDuration' in d2:
-                duration = d2['BlockDuration'][1]
-                duration = duration*0.000000001*timecode_scale
-            if 'Block' in d2:
-                handle_block(d2['Block'][1], handler, current_cluster_timecode, timecode_scale, duration, header_removal_headers_for_tracks)
+            handle_block_group(tree, handler, current_cluster_timecode, timecode_scale, header_removal_headers_for_tracks)
         else:
             if type_!=EET.JUST_GO_ON and type_!=EET.MASTER:
                 data = read_simple_element(f, type_, size)
 
         handler.ebml_top_element(id_, name, type_, data);
+        if handler.finished:
+            break
+
+    handler.bytes_parsed = f.tell() - start_position - handler.bytes_skipped - handler.bytes_resynced
+
+def mkvparse_buffer(data, handler, pos=0, end=None):
+    '''
+        Just like mkvparse, but parses bytes-like data (like mmap of the whole file) from pos to end.
+        Numbers are decoded straight from the buffer and frame() gets zero-copy memoryview slices
+        of data on Python 3 (unless header removal compression is used), which must not be kept
+        after the buffer is closed.
+    '''
+    view = buffer_view(data)
+    end = len(data) if end is None else end
+    timecode_scale = 1000000
+    current_cluster_timecode = 0
+    header_removal_headers_for_tracks = {}
+    handler.bytes_skipped = 0
+    handler.bytes_resynced = 0
+    start_position = pos
+    while pos < end:
+        start = pos
+        tree = None
+        value = None
+        try:
+            (id_, size, pos) = parse_ebml_element_header(view, pos)
+            if not (id_ in element_types_names):
+                sys.stderr.write("mkvparse: Unknown element with id %x and size %d\n"%(id_, size))
+                pos = resync_buffer(data, start+1, end)
+                handler.bytes_resynced += (end if pos is None else pos) - start
+                if pos is None:
+                    break
+                continue
+
+            (type_, name) = element_types_names[id_]
+
+            if type_==EET.MASTER:
+                subscribed_tracks = handler.subscribed_tracks if name=="BlockGroup" else None
+                tree = parse_ebml_element_tree(view, pos, size, subscribed_tracks)
+                value = tree
+            elif name=="Cluster" and handler.cluster_positions is not None:
+                # jump to the next cluster the handler asked for, stop after the last one
+                i = bisect_left(handler.cluster_positions, start)
+                if i == len(handler.cluster_positions):
+                    break
+                if handler.cluster_positions[i] != start:
+                    handler.bytes_skipped += handler.cluster_positions[i] - start
+                    pos = handler.cluster_positions[i]
+                    continue
+            elif name=="SimpleBlock":
+                if handler.subscribed_tracks is None or parse_matroska_number(view, pos)[0] in handler.subscribed_tracks:
+                    value = view[pos:pos+size]
+                else:
+                    handler.bytes_skipped += size
+            elif type_!=EET.JUST_GO_ON:
+                value = parse_simple_element(view, pos, type_, size)
+        except Exception:
+            traceback.print_exc()
+            pos = resync_buffer(data, start+1, end)
+            handler.bytes_resynced += (end if pos is None else pos) - start
+            if pos is None:
+                break
+            continue
+
+        if type_!=EET.JUST_GO_ON:
+            pos += size
+
+        if name=="EBML":
+            check_ebml_header(tree)
+        elif name=="Info":
+            timecode_scale = handle_segment_info(handler, tree, timecode_scale)
+        elif name=="Tracks":
+            handle_tracks(handler, tree, header_removal_headers_for_tracks)
+        # cluster contents:
+        elif name=="Timecode":
+            current_cluster_timecode = value
+        elif name=="SimpleBlock":
+            if value is not None:
+                handle_block(value, handler, current_cluster_timecode, timecode_scale, None, header_removal_headers_for_tracks)
+        elif name=="BlockGroup" and tree is not None:
+            handle_block_group(tree, handler, current_cluster_timecode, timecode_scale, header_removal_headers_for_tracks)
+        elif name=="BlockGroup":
+            handler.bytes_skipped += size # block of unsubscribed track
+
+        handler.ebml_top_element(id_, name, type_, value);
+        if handler.finished:
+            break
 
+    handler.bytes_parsed = (end if pos is None else min(pos, end)) - start_position - handler.bytes_skipped - \
+        handler.bytes_resynced
 
 
 if __name__ == '__main__':
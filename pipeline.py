@@ -0,0 +1,106 @@
+from __future__ import division, unicode_literals
+
+import pysubs2
+from algorithms import solver_driver, apply_shift, select_reference_track, StopCondition
+from instrumentation import Stats
+from mkvhandler import extract_subtitle_tracks
+from timings import Timings
+
+ENCODING = "latin-1"
+
+
+def load_reference(path, cache=None, encoding=ENCODING, stats=None, subs=None, sample_lines=None, processes=1):
+    """
+    Returns Timings of reference subtitles, extracting them from MKV files. Of several
+    subtitle tracks, the one most similar to subs (Timings) is chosen (the first one without subs).
+    With sample_lines, only a sample of MKV subtitles is extracted (for a quick estimate).
+    processes are used to parse large MKV files (see mkvhandler.extract_subtitle_tracks).
+    """
+    stats = Stats() if stats is None else stats
+    if is_mkv(path):
+        with stats.stage("extract"):
+            tracks = extract_subtitle_tracks(path, cache, stats, sample_lines, processes)
+        stats.count("subtitle_tracks", len(tracks))
+        if subs is None or len(tracks) == 1:
+            return tracks[next(iter(tracks))]
+        with stats.stage("cluster"):
+            return tracks[select_reference_track(tracks, subs)]
+    else:
+        with stats.stage("load"):
+            return Timings.from_subs(pysubs2.load(path, encoding))
+
+def is_mkv(path):
+    return path.lower().endswith(".mkv")
+
+def load_pair(ref_path, subs_path, cache=None, encoding=ENCODING, stats=None, sample_lines=None, processes=1):
+    """Returns (SSAFile, its Timings, reference Timings) of a pair, see load_reference"""
+    stats = Stats() if stats is None else stats
+    with stats.stage("load"):
+        subs = pysubs2.load(subs_path, encoding)
+        timings = Timings.from_subs(subs)
+    return subs, timings, load_reference(ref_path, cache, encoding, stats, timings, sample_lines, processes)
+
+def solve_pair(ref_path, ref_timings, timings, settings, progress=None, cache=None, encoding=ENCODING, stats=None,
+               stop=None, sample_lines=None, refine=False, estimated=None, processes=1):
+    """Returns (delta, error) of timings against ref_timings loaded by load_pair, see retime"""
+    stats = Stats() if stats is None else stats
+    stop = StopCondition() if stop is None else stop
+
+    def solve(ref_timings, x0=0):
+        delta, error = None, None
+        for i, t, x, fx in solver_driver(ref_timings, timings, stats=stats, stop=stop, x0=x0, **settings):
+            if i is None:
+                delta, error = x, fx
+            elif progress is not None:
+                progress(i, t, x, fx)
+        return delta, error
+
+    delta, error = solve(ref_timings)
+
+    if sample_lines and refine and is_mkv(ref_path) and stop.reason not in ("cancelled", "time"):
+        if estimated is not None:
+            estimated(delta, error)
+        stop.reason = None
+        ref_timings = load_reference(ref_path, cache, encoding, stats, timings, processes=processes)
+        delta, error = solve(ref_timings, x0=0 if hasattr(delta, "apply") else delta)
+
+    return delta, error
+
+def save_shifted(subs, subs_path, delta, encoding=ENCODING, stats=None):
+    """Shifts SSAFile by delta (ms or PiecewiseShift) and saves it to subs_path"""
+    stats = Stats() if stats is None else stats
+    with stats.stage("save"):
+        apply_shift(subs, delta)
+        subs.save(subs_path, encoding)
+
+def was_written(write_file, stop):
+    """Tells if retime saves the subtitles, which it doesn't when the solver was cancelled"""
+    return write_file and stop.reason != "cancelled"
+
+def retime(ref_path, subs_path, settings, write_file=False, progress=None, cache=None, encoding=ENCODING, stats=None,
+           stop=None, sample_lines=None, refine=False, estimated=None, processes=1):
+    """
+    Finds shift of subtitles in subs_path against reference, optionally shifting and saving the file.
+
+    settings are passed to solver_driver, progress (if given) is called with every (i, t, x, fx)
+    the solver yields. Stage times and counters are collected in stats (instrumentation.Stats),
+    if given. stop (algorithms.StopCondition) ends the solver early and tells why in stop.reason.
+    Returns (delta, error), where delta is shift in ms or PiecewiseShift.
+
+    With sample_lines, the shift is estimated from a sample of MKV reference subtitles. With
+    refine, the estimate is passed to estimated(delta, error) (if given) and the solver is run
+    again on the full reference, annealing starting from the estimate. MKV references are
+    extracted by processes (None for number of CPUs) if they are large enough.
+
+    A cancelled (stop.reason "cancelled") shift is not saved, see was_written().
+    """
+    stats = Stats() if stats is None else stats
+    stop = StopCondition() if stop is None else stop
+    with stats.profiling():
+        subs, timings, ref_timings = load_pair(ref_path, subs_path, cache, encoding, stats, sample_lines, processes)
+        delta, error = solve_pair(ref_path, ref_timings, timings, settings, progress, cache, encoding, stats, stop,
+                                  sample_lines, refine, estimated, processes)
+        if was_written(write_file, stop):
+            save_shifted(subs, subs_path, delta, encoding, stats)
+
+    return delta, error
@@ -0,0 +1,47 @@
+from __future__ import division, unicode_literals
+
+import time
+from collections import namedtuple
+
+# Coalesced state of a running solver: last (i, t, x, fx) it yielded, best state so far,
+# number of updates seen and seconds since the start.
+Progress = namedtuple("Progress", "i t x fx bestx bestfx count elapsed")
+
+
+class ProgressChannel(object):
+    """
+    Callable taking solver progress (i, t, x, fx), calling callback(Progress) at most once
+    per interval seconds. Intermediate updates are only folded into the best state and count,
+    so a call costs about one time.time(). Call flush() at the end to deliver the last state.
+
+    Pass it as progress to pipeline.retime; callback can be eg. a Qt signal emit (it is called
+    from the thread running the solver) or a function drawing a console progress bar.
+    """
+    def __init__(self, callback, interval=0.05):
+        self.callback = callback
+        self.interval = interval
+        self.started = time.time()
+        self.last_sent = None
+        self.last = None
+        self.bestx, self.bestfx = None, None
+        self.count, self.sent_count = 0, 0
+
+    def __call__(self, i, t, x, fx):
+        self.count += 1
+        if self.bestfx is None or fx < self.bestfx:
+            self.bestx, self.bestfx = x, fx
+        self.last = (i, t, x, fx)
+
+        now = time.time()
+        if self.last_sent is None or now - self.last_sent >= self.interval:
+            self.send(now)
+
+    def send(self, now):
+        self.last_sent, self.sent_count = now, self.count
+        i, t, x, fx = self.last
+        self.callback(Progress(i, t, x, fx, self.bestx, self.bestfx, self.count, now - self.started))
+
+    def flush(self):
+        """Delivers the latest state if it was not sent yet"""
+        if self.count > self.sent_count:
+            self.send(time.time())
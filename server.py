@@ -0,0 +1,377 @@
+"""
+Retiming server: keeps worker processes with imported modules and extracted references
+warm and accepts jobs over HTTP on localhost, for ingest systems retiming many files.
+
+    python server.py --port 8765 --workers 4
+
+POST /jobs          {"ref": path, "subs": path, "write": false, ...} -> 202 {"id": ...}
+                    other keys override solver options of cli.py (see JOB_OPTIONS)
+GET /jobs           states of all jobs
+GET /jobs/ID        state, progress and result (as written by cli.py) of a job
+GET /jobs/ID/progress   latest solver progress of a job
+DELETE /jobs/ID     cancels a queued or running job
+GET /status         workers, queue length and job counts
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import deque, OrderedDict
+from six.moves import BaseHTTPServer, queue, socketserver
+from cache import MemoryCache, SubtitleCache
+from cli import get_parser, run_job, solver_settings, to_json
+from progress import ProgressChannel
+
+_text = type("") # unicode on Python 2
+
+# request keys -> (cli.py option, type)
+JOB_OPTIONS = {
+    "method": ("method", _text),
+    "objective": ("objective", _text),
+    "unit": ("unit", int),
+    "step": ("step", float),
+    "iterations": ("iterations", int),
+    "chains": ("chains", int),
+    "seed": ("seed", int),
+    "sample": ("sample", int),
+    "refine": ("refine", bool),
+    "patience": ("patience", int),
+    "target": ("target", float),
+    "time_limit": ("time_limit", float),
+    "encoding": ("encoding", _text),
+    "write": ("write", bool),
+    "cache": ("no_cache", lambda cache: not cache),
+}
+PROGRESS_INTERVAL = 0.2
+WORKER_CHECK_INTERVAL = 1.0
+MAX_FINISHED_JOBS = 1000
+
+
+class SharedToken(object):
+    """CancellationToken backed by a byte of shared memory, so the server can stop a job in a worker"""
+    def __init__(self, flags, slot):
+        self.flags = flags
+        self.slot = slot
+
+    def cancel(self):
+        self.flags[self.slot] = 1
+
+    @property
+    def cancelled(self):
+        return bool(self.flags[self.slot])
+
+
+def worker_main(tasks, events, flags, cache_entries):
+    """
+    Worker process loop: runs (job id, slot, cli.run_job job) tasks until None, sending
+    ("started", id, pid), ("progress", id, dict) and ("done", id, result) to events.
+    Extracted references stay in memory between jobs.
+    """
+    cache = MemoryCache(SubtitleCache(), cache_entries)
+    for job_id, slot, job in iter(tasks.get, None):
+        events.put(("started", job_id, os.getpid()))
+
+        def send(progress, job_id=job_id):
+            events.put(("progress", job_id, dict(progress._asdict(), x=to_json(progress.x),
+                                                 bestx=to_json(progress.bestx))))
+
+        try:
+            result = run_job(job, cache, SharedToken(flags, slot), ProgressChannel(send, PROGRESS_INTERVAL))
+        except Exception:
+            result = {"ref": job[0], "subs": job[1], "failed": traceback.format_exc()}
+        events.put(("done", job_id, result))
+
+
+class RetimeServer(object):
+    """
+    Job queue in front of a pool of pre-forked worker processes.
+
+    Jobs wait in the queue of the server and a dispatcher thread hands one to each idle
+    worker, so a job can be cancelled before it starts and a running job is stopped through
+    the shared flag of its worker slot. Finished jobs are kept (up to MAX_FINISHED_JOBS)
+    for status requests. A worker that dies (eg. killed for using too much memory) fails
+    its job and is replaced.
+    """
+    def __init__(self, workers=None, cache_entries=32, defaults=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        parser = get_parser()
+        self.defaults = defaults or parser.parse_args([])
+        self.choices = dict((action.dest, action.choices) for action in parser._actions if action.choices)
+        self.jobs = OrderedDict()
+        self.queue = deque()
+        self.free_slots = list(range(self.workers))
+        self.running = {} # slot -> job id
+        self.ids = itertools.count(1)
+        self.lock = threading.Condition()
+        self.closed = False
+
+        self.cache_entries = cache_entries
+        self.flags = multiprocessing.RawArray("b", self.workers)
+        self.events = multiprocessing.Queue()
+        self.tasks = [None] * self.workers
+        self.processes = [None] * self.workers
+        for slot in range(self.workers):
+            self.start_worker(slot)
+
+        self.threads = [threading.Thread(target=self.dispatch), threading.Thread(target=self.collect)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def start_worker(self, slot):
+        # own task queue, a worker killed while waiting for a task would keep a shared one locked
+        self.tasks[slot] = multiprocessing.Queue()
+        # not daemonic, jobs with multistart chains start their own pools
+        self.processes[slot] = multiprocessing.Process(target=worker_main, args=(
+            self.tasks[slot], self.events, self.flags, self.cache_entries))
+        self.processes[slot].start()
+
+    def make_job(self, request):
+        """Returns cli.run_job job of request dict or raises ValueError"""
+        if not isinstance(request, dict) or not request.get("ref") or not request.get("subs"):
+            raise ValueError("\"ref\" and \"subs\" paths are required")
+        args = copy.copy(self.defaults)
+        for key, value in request.items():
+            if key in ("ref", "subs"):
+                continue
+            if key not in JOB_OPTIONS:
+                raise ValueError("Unknown option %r" % key)
+            (name, type_) = JOB_OPTIONS[key]
+            if value is None and getattr(self.defaults, name) is not None:
+                raise ValueError("%r can't be null" % key)
+            try:
+                value = None if value is None else type_(value)
+            except TypeError: # eg. list or dict
+                raise ValueError("Bad value of %r: %r" % (key, value))
+            if name in self.choices and value not in self.choices[name]:
+                raise ValueError("%r must be one of %s" % (key, ", ".join(self.choices[name])))
+            setattr(args, name, value)
+
+        try:
+            settings, stop_criteria = solver_settings(args)
+        except ArithmeticError: # zero step or iterations
+            raise ValueError("Bad solver options")
+        return (request["ref"], request["subs"], settings, stop_criteria, args.sample, args.refine, args.write,
+                not args.no_cache, args.encoding, False, False, 1)
+
+    def submit(self, request):
+        """Queues a job of request dict, returns its id"""
+        job = self.make_job(request)
+        with self.lock:
+            job_id = "%d" % next(self.ids)
+            self.jobs[job_id] = {"id": job_id, "ref": job[0], "subs": job[1], "state": "queued",
+                                 "submitted": time.time(), "progress": None, "result": None}
+            self.queue.append((job_id, job))
+            self.lock.notify_all()
+        return job_id
+
+    def cancel(self, job_id):
+        """Cancels a job, returns False if it is not queued or running"""
+        with self.lock:
+            state = self.jobs.get(job_id)
+            if state is None or state["state"] not in ("queued", "running"):
+                return False
+            if state["state"] == "queued":
+                self.queue = deque(item for item in self.queue if item[0] != job_id)
+                self.finish(state, "cancelled", None)
+            else:
+                self.flags[state["slot"]] = 1
+            return True
+
+    def get(self, job_id):
+        with self.lock:
+            state = self.jobs.get(job_id)
+            return None if state is None else dict((k, v) for k, v in state.items() if k != "slot")
+
+    def list_jobs(self):
+        with self.lock:
+            return [dict((k, state[k]) for k in ("id", "ref", "subs", "state")) for state in self.jobs.values()]
+
+    def status(self):
+        with self.lock:
+            counts = {}
+            for state in self.jobs.values():
+                counts[state["state"]] = counts.get(state["state"], 0) + 1
+            return {"workers": self.workers, "idle_workers": len(self.free_slots), "queued": len(self.queue),
+                    "jobs": counts}
+
+    def dispatch(self):
+        while True:
+            with self.lock:
+                while not self.closed and not (self.queue and self.free_slots):
+                    self.lock.wait()
+                if self.closed:
+                    return
+                (job_id, job) = self.queue.popleft()
+                slot = self.free_slots.pop()
+                self.flags[slot] = 0
+                self.running[slot] = job_id
+                self.jobs[job_id].update(state="running", slot=slot)
+                self.tasks[slot].put((job_id, slot, job))
+
+    def collect(self):
+        checked = time.time()
+        while True:
+            try:
+                event = self.events.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                event = ()
+            if event is None:
+                return
+            with self.lock:
+                if event:
+                    self.handle_event(*event)
+                if not self.closed and time.time() - checked >= WORKER_CHECK_INTERVAL:
+                    self.check_workers()
+                    checked = time.time()
+
+    def handle_event(self, kind, job_id, data):
+        state = self.jobs.get(job_id)
+        if state is None or state["state"] != "running":
+            return # failed when its worker died
+        if kind == "started":
+            state.update(started=time.time(), worker=data)
+        elif kind == "progress":
+            state["progress"] = data
+        elif kind == "done":
+            self.release(state["slot"])
+            if "failed" in data:
+                self.finish(state, "failed", data)
+            else:
+                self.finish(state, "cancelled" if data.get("stop_reason") == "cancelled" else "done", data)
+
+    def check_workers(self):
+        """Fails jobs of dead workers and starts new workers in their slots"""
+        for slot, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            process.join()
+            if slot in self.running:
+                state = self.jobs[self.running[slot]]
+                self.release(slot)
+                self.finish(state, "failed", {"ref": state["ref"], "subs": state["subs"],
+                                              "failed": "Worker process exited with code %s" % process.exitcode})
+            self.start_worker(slot)
+
+    def release(self, slot):
+        del self.running[slot]
+        self.free_slots.append(slot)
+        self.lock.notify_all()
+
+    def finish(self, state, name, result):
+        state.update(state=name, result=result, finished=time.time())
+        finished = [job_id for job_id, job in self.jobs.items() if job["state"] not in ("queued", "running")]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def close(self):
+        """Stops the workers after their current jobs, queued jobs are dropped"""
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.events.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """JSON API of RetimeServer (self.server.retimer)"""
+    JOB_PATH = re.compile(r"^/jobs/([^/]+)(/progress)?$")
+
+    def do_GET(self):
+        retimer = self.server.retimer
+        match = self.JOB_PATH.match(self.path)
+        if self.path == "/status":
+            self.reply(200, retimer.status())
+        elif self.path == "/jobs":
+            self.reply(200, retimer.list_jobs())
+        elif match:
+            state = retimer.get(match.group(1))
+            if state is None:
+                self.reply(404, {"error": "no such job"})
+            elif match.group(2):
+                self.reply(200, {"id": state["id"], "state": state["state"], "progress": state["progress"]})
+            else:
+                self.reply(200, state)
+        else:
+            self.reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self.reply(404, {"error": "not found"})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            job_id = self.server.retimer.submit(json.loads(body.decode("utf-8")))
+        except ValueError as exc: # also bad JSON
+            self.reply(400, {"error": str(exc)})
+        else:
+            self.reply(202, {"id": job_id})
+
+    def do_DELETE(self):
+        match = self.JOB_PATH.match(self.path)
+        if not match or match.group(2):
+            self.reply(404, {"error": "not found"})
+        elif self.server.retimer.cancel(match.group(1)):
+            self.reply(200, {"id": match.group(1), "cancelled": True})
+        else:
+            self.reply(409, {"error": "job is not queued or running"})
+
+    def reply(self, code, data):
+        body = json.dumps(data, sort_keys=True).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "%d" % len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class HTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve retiming jobs over HTTP on localhost.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (localhost by default)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="number of worker processes")
+    parser.add_argument("--cache-entries", type=int, default=32,
+                        help="extracted MKV references kept in memory by each worker")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log requests to stderr")
+    args = parser.parse_args(argv)
+
+    retimer = RetimeServer(args.workers, args.cache_entries)
+    httpd = HTTPServer((args.host, args.port), RequestHandler)
+    httpd.retimer = retimer
+    httpd.verbose = args.verbose
+    sys.stderr.write("Serving on http://%s:%d/ with %d workers\n" % (args.host, httpd.server_address[1], args.workers))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        retimer.close()
+    return 0
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    sys.exit(main())
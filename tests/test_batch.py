@@ -0,0 +1,49 @@
+from __future__ import division, unicode_literals
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import batch
+from batch import retime_batch
+from benchmarks.synthetic import make_subtitles, make_retimed
+
+SETTINGS = {"unit": 100, "t0": 5000, "decay": 0.98, "iterations": 400, "seed": 0}
+
+
+class RetimeBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pairs = []
+        for i in range(3):
+            ref = make_subtitles(duration=10*60*1000, seed=i)
+            ref_path = os.path.join(self.directory, "ref%d.srt" % i)
+            subs_path = os.path.join(self.directory, "subs%d.srt" % i)
+            ref.save(ref_path)
+            make_retimed(ref, shift=-1000*(i+1), seed=i).save(subs_path)
+            self.pairs.append((ref_path, subs_path))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_results(self):
+        jobs = sorted(retime_batch(self.pairs, SETTINGS, write_file=True), key=lambda job: job.subs_path)
+        self.assertEqual([job.failed for job in jobs], [None] * 3)
+        for i, job in enumerate(jobs):
+            self.assertAlmostEqual(job.delta, 1000*(i+1), delta=SETTINGS["unit"])
+            self.assertTrue(job.written)
+
+    def test_time_limit_starts_with_solving(self):
+        load_pair = batch.load_pair
+        def slow_load_pair(*args):
+            time.sleep(0.3)
+            return load_pair(*args)
+
+        batch.load_pair = slow_load_pair
+        try:
+            jobs = list(retime_batch(self.pairs, SETTINGS, stop_criteria={"time_limit": 0.25}))
+        finally:
+            batch.load_pair = load_pair
+        self.assertEqual(len(jobs), 3)
+        self.assertNotIn("time", [job.stop.reason for job in jobs])
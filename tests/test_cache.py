@@ -0,0 +1,76 @@
+from __future__ import division, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+from io import open
+from cache import SubtitleCache
+from mkvhandler import extract_subtitle_tracks
+from timings import Timings
+from benchmarks.synthetic import make_subtitles, make_mkv
+
+
+class SubtitleCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = SubtitleCache(os.path.join(self.directory, "cache"))
+        self.path = os.path.join(self.directory, "ref.mkv")
+        with open(self.path, "wb") as fp:
+            fp.write(b"\x1a\x45\xdf\xa3")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        self.cache.put_tracks(self.path, {3: Timings.from_arrays([0, 1000], [500, 2000])})
+        tracks = self.cache.get_tracks(self.path)
+        self.assertEqual(list(tracks), [3])
+        self.assertEqual(tracks[3].starts.tolist(), [0, 1000])
+        self.assertEqual(tracks[3].ends.tolist(), [500, 2000])
+
+    def test_damaged_entry_is_a_miss(self):
+        self.cache.put_tracks(self.path, {3: Timings.from_arrays([0, 1000], [500, 2000])})
+        for name in os.listdir(self.cache.directory):
+            with open(os.path.join(self.cache.directory, name), "ab") as fp:
+                fp.write(b"\x00")
+        self.assertIsNone(self.cache.get_tracks(self.path))
+
+    def test_entries_removed_by_another_process(self):
+        self.cache.max_size = 0
+        self.cache.put_tracks(self.path, {3: Timings.from_arrays([0, 1000], [500, 2000])})
+        listdir = os.listdir
+        try:
+            os.listdir = lambda directory: listdir(directory) + ["vanished.bin"]
+            self.cache.evict()
+        finally:
+            os.listdir = listdir
+        self.assertEqual([name for name in os.listdir(self.cache.directory) if name.endswith(".bin")], [])
+
+    def test_directory_created_by_another_process(self):
+        os.makedirs(self.cache.directory)
+        self.cache.put_tracks(self.path, {3: Timings.from_arrays([0, 1000], [500, 2000])})
+        self.assertEqual(list(self.cache.get_tracks(self.path)), [3])
+
+
+class FailingCache(object):
+    def get_tracks(self, path):
+        return None
+
+    def put_tracks(self, path, tracks):
+        raise OSError("disk full")
+
+
+class ExtractionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "ref.mkv")
+        make_mkv(self.path, make_subtitles(duration=20*1000, seed=1), video_frame_size=200)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache_failure_does_not_fail_extraction(self):
+        tracks = extract_subtitle_tracks(self.path, FailingCache())
+        self.assertEqual(list(tracks), [3])
+        self.assertTrue(len(tracks[3]) > 0)
@@ -0,0 +1,89 @@
+from __future__ import division, unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from io import open
+from cli import expand_globs, main, read_manifest
+from benchmarks.synthetic import make_subtitles, make_retimed
+
+SHIFTS = (-2000, 1500, 3000)
+
+
+class CliTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ref_path = self.path("ref.srt")
+        ref = make_subtitles(duration=10*60*1000, seed=8)
+        ref.save(self.ref_path)
+        self.subs_paths = []
+        for i, shift in enumerate(SHIFTS):
+            self.subs_paths.append(self.path("subs%d.srt" % i))
+            make_retimed(ref, shift=shift, seed=i).save(self.subs_paths[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, text):
+        with open(self.path(name), "w", encoding="utf-8") as fp:
+            fp.write(text)
+        return self.path(name)
+
+    def run_main(self, *argv):
+        """Returns (exit code, results of main by subs path)"""
+        output = self.path("results.jsonl")
+        code = main(["--method", "fft", "--no-cache", "-o", output] + list(argv))
+        with open(output, encoding="utf-8") as fp:
+            results = [json.loads(line) for line in fp]
+        self.assertEqual(len(results), len(set(result["subs"] for result in results)))
+        return code, dict((result["subs"], result) for result in results)
+
+    def test_read_manifest(self):
+        manifest = self.write("manifest.txt", "# comment\n\n%s\t%s\n{\"ref\": \"%s\", \"subs\": \"%s\"}\n" % (
+            "a.mkv", "a.srt", "b.mkv", "b.ass"))
+        self.assertEqual(read_manifest(manifest), [("a.mkv", "a.srt"), ("b.mkv", "b.ass")])
+
+    def test_expand_globs(self):
+        self.assertEqual(expand_globs(self.ref_path, self.path("subs*.srt")),
+                         [(self.ref_path, path) for path in self.subs_paths])
+        for name in ("a.srt", "b.srt"):
+            shutil.copy(self.ref_path, self.path("refs-" + name))
+        self.assertEqual(expand_globs(self.path("refs-*.srt"), self.path("subs[01].srt")),
+                         [(self.path("refs-a.srt"), self.subs_paths[0]), (self.path("refs-b.srt"), self.subs_paths[1])])
+        self.assertRaises(ValueError, expand_globs, self.path("refs-*.srt"), self.path("subs*.srt"))
+        self.assertRaises(SystemExit, main, ["--ref", self.path("refs-*.srt"), "--subs", self.path("subs*.srt")])
+
+    def test_main(self):
+        manifest = self.write("manifest.txt", "%s\t%s\n" % (self.ref_path, self.subs_paths[2]))
+        for jobs in ("1", "2"): # stages or process pool
+            code, results = self.run_main("-j", jobs, "--pair", self.ref_path, self.subs_paths[0],
+                                          "--ref", self.ref_path, "--subs", self.subs_paths[1], "--manifest", manifest)
+            self.assertEqual(code, 0)
+            self.assertEqual(sorted(results), sorted(self.subs_paths))
+            for path, shift in zip(self.subs_paths, SHIFTS):
+                self.assertEqual(results[path]["shift"], -shift)
+                self.assertFalse(results[path]["written"])
+
+    def test_failed_pair(self):
+        missing = self.path("missing.srt")
+        for jobs in ("1", "2"):
+            code, results = self.run_main("-j", jobs, "--pair", self.ref_path, self.subs_paths[0],
+                                          "--pair", self.ref_path, missing)
+            self.assertEqual(code, 1)
+            self.assertEqual(results[self.subs_paths[0]]["shift"], -SHIFTS[0])
+            self.assertIn("failed", results[missing])
+        code, results = self.run_main("--pair", self.ref_path, missing)
+        self.assertEqual(code, 1)
+        self.assertIn("failed", results[missing])
+
+    def test_write(self):
+        code, results = self.run_main("-w", "--pair", self.ref_path, self.subs_paths[0])
+        self.assertEqual(code, 0)
+        self.assertTrue(results[self.subs_paths[0]]["written"])
+        code, results = self.run_main("--pair", self.ref_path, self.subs_paths[0])
+        self.assertEqual(results[self.subs_paths[0]]["shift"], 0)
@@ -0,0 +1,138 @@
+from __future__ import division, unicode_literals
+
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+from io import open
+import mkvparse
+from mkvhandler import element_at, extract_subtitle_track, probe, read_cue_clusters
+from benchmarks.synthetic import make_subtitles, make_mkv
+
+LACING_MODES = ("none", "xiph", "ebml", "fixed")
+
+
+class FrameHandler(mkvparse.MatroskaHandler):
+    def __init__(self, subscribed_tracks=None):
+        self.subscribed_tracks = subscribed_tracks
+        self.frames = []
+
+    def frame(self, track_id, timestamp, data, more_laced_frames, duration, keyframe, invisible, discardable):
+        self.frames.append((track_id, round(timestamp * 1000), bytes(data), more_laced_frames,
+                            None if duration is None else round(duration * 1000), keyframe))
+
+def parse_file(path, handler):
+    with open(path, "rb") as fp:
+        mkvparse.mkvparse(fp, handler)
+    return handler
+
+def parse_mmap(path, handler):
+    with open(path, "rb") as fp:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            mkvparse.mkvparse_buffer(data, handler)
+        finally:
+            data.close()
+    return handler
+
+
+class ParserTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.subs = make_subtitles(duration=60*1000, lines_per_minute=20, seed=1)
+        for lacing in LACING_MODES:
+            make_mkv(os.path.join(cls.directory, "%s.mkv" % lacing), cls.subs, video_frame_size=200,
+                     audio_lacing=lacing, cluster_ms=2000, seed=1)
+        make_mkv(os.path.join(cls.directory, "nocues.mkv"), cls.subs, video_frame_size=200, cluster_ms=2000,
+                 cues=False, seed=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, "%s.mkv" % name)
+
+    def expected_subtitles(self):
+        return [(3, line.start, line.text.encode("utf-8"), line.end - line.start) for line in self.subs]
+
+    def test_file_and_mmap_parsers_agree(self):
+        for lacing in LACING_MODES:
+            frames = parse_file(self.path(lacing), FrameHandler()).frames
+            self.assertEqual(frames, parse_mmap(self.path(lacing), FrameHandler()).frames, lacing)
+
+    def test_subtitle_frames(self):
+        for parse in (parse_file, parse_mmap):
+            for lacing in LACING_MODES:
+                frames = parse(self.path(lacing), FrameHandler()).frames
+                subtitles = [(track, t, data, duration) for track, t, data, _, duration, _ in frames if track == 3]
+                self.assertEqual(subtitles, self.expected_subtitles(), lacing)
+
+    def test_audio_lacing(self):
+        sizes = {"none": [200], "fixed": [200] * 4, "xiph": [200, 207, 214, 221], "ebml": [200, 207, 214, 221]}
+        for parse in (parse_file, parse_mmap):
+            for lacing in LACING_MODES:
+                frames = [(len(data), more) for track, _, data, more, _, _ in
+                          parse(self.path(lacing), FrameHandler()).frames if track == 2]
+                self.assertTrue(frames, lacing)
+                block = [(size, len(sizes[lacing]) - 1 - i) for i, size in enumerate(sizes[lacing])]
+                self.assertEqual(frames, block * (len(frames) // len(block)), lacing)
+
+    def test_subscribed_tracks(self):
+        for parse in (parse_file, parse_mmap):
+            handler = parse(self.path("xiph"), FrameHandler(subscribed_tracks={3}))
+            self.assertEqual(set(frame[0] for frame in handler.frames), {3})
+            self.assertGreater(handler.bytes_skipped, 0)
+
+    def test_truncated_file(self):
+        with open(self.path("xiph"), "rb") as fp:
+            data = fp.read()
+        cluster = data.find(b"\x1f\x43\xb6\x75")
+        for length in range(cluster, cluster + 2000): # cuts headers of blocks too
+            mkvparse.mkvparse(io.BytesIO(data[:length]), FrameHandler(subscribed_tracks={3}))
+            mkvparse.mkvparse_buffer(data[:length], FrameHandler(subscribed_tracks={3}))
+
+    def test_extract_subtitle_track(self):
+        for name in ("xiph", "nocues"):
+            timings = extract_subtitle_track(self.path(name))
+            self.assertEqual(timings.starts.tolist(), [line.start for line in self.subs])
+            self.assertEqual(timings.ends.tolist(), [line.end for line in self.subs])
+            self.assertEqual(timings.text(0), self.subs[0].text)
+
+    def test_no_subtitle_track(self):
+        with open(self.path("xiph"), "rb") as fp:
+            data = fp.read().replace(b"S_TEXT/UTF8", b"S_VOBSUB/XX")
+        path = self.path("notext")
+        with open(path, "wb") as fp:
+            fp.write(data)
+        self.assertRaises(RuntimeError, extract_subtitle_track, path)
+
+    def test_iter_elements(self):
+        with open(self.path("xiph"), "rb") as fp:
+            for source in (fp, fp.read()):
+                names = [element.name for element in mkvparse.iter_elements(source)]
+                self.assertEqual(names, ["EBML", "Segment"])
+                segment = list(mkvparse.iter_elements(source))[1]
+                children = [element.name for element in segment.children() if element.name != "Void"]
+                self.assertEqual(children[:3], ["SeekHead", "Info", "Tracks"])
+                self.assertEqual(children[-1], "Cues")
+                info = [child for child in segment.children() if child.name == "Info"][0]
+                self.assertEqual(dict((c.name, c.value()) for c in info.children())["TimecodeScale"], 1000000)
+
+    def test_read_cue_clusters(self):
+        with open(self.path("xiph"), "rb") as fp:
+            clusters = read_cue_clusters(fp)
+            self.assertEqual(sorted(clusters), [1, 3])
+            for offset in clusters[3]:
+                self.assertEqual(element_at(fp, offset).name, "Cluster")
+        with open(self.path("nocues"), "rb") as fp:
+            self.assertEqual(read_cue_clusters(fp), {})
+
+    def test_probe(self):
+        info = probe(self.path("xiph"))
+        self.assertEqual(info["timecode_scale"], 1000000)
+        self.assertEqual([(track["number"], track["type"], track["codec"]) for track in info["tracks"]],
+                         [(1, "video", "V_MPEG4/ISO/AVC"), (2, "audio", "A_AAC"), (3, "subtitle", "S_TEXT/UTF8")])
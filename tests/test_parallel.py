@@ -0,0 +1,53 @@
+from __future__ import division, unicode_literals
+
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+from io import open
+import mkvhandler
+from mkvhandler import extract_subtitle_tracks, find_segment, scan_clusters, CLUSTER_ID
+from benchmarks.synthetic import make_subtitles, make_mkv
+
+
+class ParallelExtractionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        subs = make_subtitles(duration=5*60*1000, lines_per_minute=30, seed=5)
+        signs = make_subtitles(duration=5*60*1000, lines_per_minute=3, seed=6)
+        for cues in (True, False):
+            make_mkv(cls.path(cues), subs, video_frame_size=200, cluster_ms=2000, cues=cues, seed=5,
+                     extra_subs=[signs])
+        cls.min_bytes = mkvhandler.PARALLEL_MIN_BYTES
+        mkvhandler.PARALLEL_MIN_BYTES = 0
+
+    @classmethod
+    def tearDownClass(cls):
+        mkvhandler.PARALLEL_MIN_BYTES = cls.min_bytes
+        shutil.rmtree(cls.directory)
+
+    @classmethod
+    def path(cls, cues):
+        return os.path.join(cls.directory, "cues.mkv" if cues else "nocues.mkv")
+
+    def test_same_as_serial(self):
+        for cues in (True, False):
+            serial = extract_subtitle_tracks(self.path(cues))
+            parallel = extract_subtitle_tracks(self.path(cues), processes=3)
+            self.assertEqual(list(parallel), list(serial))
+            for track in serial:
+                self.assertEqual(parallel[track].starts.tolist(), serial[track].starts.tolist())
+                self.assertEqual(parallel[track].ends.tolist(), serial[track].ends.tolist())
+                self.assertEqual(parallel[track].payloads, serial[track].payloads)
+
+    def test_scan_clusters(self):
+        with open(self.path(False), "rb") as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                segment = find_segment(data)
+                clusters = [element.offset for element in segment.children() if element.id == CLUSTER_ID]
+                self.assertEqual(scan_clusters(data, clusters[0], segment.end), clusters)
+            finally:
+                mkvhandler.close_mapping(data)
@@ -0,0 +1,79 @@
+from __future__ import division, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+from io import open
+import pysubs2
+from algorithms import CancellationToken, StopCondition, select_reference_track
+from cache import SubtitleCache
+from instrumentation import Stats
+from pipeline import load_reference, retime
+from timings import Timings
+from benchmarks.synthetic import make_subtitles, make_retimed, make_mkv
+
+SETTINGS = {"unit": 100, "t0": 5000, "decay": 0.98, "iterations": 400, "seed": 0}
+
+
+class RetimeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ref_path = os.path.join(self.directory, "ref.srt")
+        self.subs_path = os.path.join(self.directory, "subs.srt")
+        ref = make_subtitles(duration=10*60*1000, seed=3)
+        ref.save(self.ref_path)
+        make_retimed(ref, shift=-2000, seed=3).save(self.subs_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_subs(self):
+        with open(self.subs_path, "rb") as fp:
+            return fp.read()
+
+    def test_write(self):
+        original = self.read_subs()
+        delta, error = retime(self.ref_path, self.subs_path, SETTINGS, write_file=True)
+        self.assertAlmostEqual(delta, 2000, delta=SETTINGS["unit"])
+        self.assertNotEqual(self.read_subs(), original)
+
+    def test_cancelled_is_not_written(self):
+        original = self.read_subs()
+        token = CancellationToken()
+        token.cancel()
+        stop = StopCondition(token=token)
+        retime(self.ref_path, self.subs_path, SETTINGS, write_file=True, stop=stop)
+        self.assertEqual(stop.reason, "cancelled")
+        self.assertEqual(self.read_subs(), original)
+
+
+class ReferenceTrackTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "ref.mkv")
+        self.dialogue = make_subtitles(duration=10*60*1000, seed=4)
+        self.signs = pysubs2.SSAFile()
+        for i in range(15):
+            self.signs.append(pysubs2.SSAEvent(start=40000*i, end=40000*i + 1500, text="sign %d" % i))
+        # signs first, so the first track would be the wrong one
+        make_mkv(self.path, self.signs, video_frame_size=100, extra_subs=[self.dialogue])
+        self.subs = Timings.from_subs(make_retimed(self.dialogue, shift=-2000, seed=4))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_select_reference_track(self):
+        tracks = {3: Timings.from_subs(self.signs), 4: Timings.from_subs(self.dialogue)}
+        self.assertEqual(select_reference_track(tracks, self.subs), 4)
+
+    def test_load_reference(self):
+        cache = SubtitleCache(os.path.join(self.directory, "cache"))
+        expected = [line.start for line in self.dialogue]
+        for hits in (0, 1):
+            stats = Stats()
+            timings = load_reference(self.path, cache, stats=stats, subs=self.subs)
+            self.assertEqual(timings.starts.tolist(), expected)
+            self.assertEqual(stats.counters["subtitle_tracks"], 2)
+            self.assertEqual(stats.counters.get("cache_hits", 0), hits)
+        self.assertEqual(load_reference(self.path, cache).starts.tolist(), [line.start for line in self.signs])
@@ -0,0 +1,83 @@
+from __future__ import division, unicode_literals
+
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from io import open
+import mkvparse
+from mkvhandler import SubtitleHandler
+from benchmarks.synthetic import make_subtitles, make_mkv
+
+
+def quietly(function, *args):
+    """Calls function with parser warnings and tracebacks on stderr discarded"""
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    try:
+        return function(*args)
+    finally:
+        sys.stderr = stderr
+
+
+class ResyncTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.subs = make_subtitles(duration=5*60*1000, lines_per_minute=30, seed=4)
+        path = os.path.join(cls.directory, "clean.mkv")
+        make_mkv(path, cls.subs, video_frame_size=200, cluster_ms=2000, cues=False, seed=4)
+        with open(path, "rb") as fp:
+            data = bytearray(fp.read())
+
+        rng = random.Random(4)
+        for start in (len(data) // 4, len(data) // 2):
+            data[start:start+20000] = bytearray(rng.getrandbits(8) for _ in range(20000))
+        cls.data = bytes(data[:len(data) - 1234]) # truncated too
+        cls.path = os.path.join(cls.directory, "damaged.mkv")
+        with open(cls.path, "wb") as fp:
+            fp.write(cls.data)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def check_recovered(self, handler):
+        lines = handler.subtitle_tracks[3]
+        original = set((line.start, line.text) for line in self.subs)
+        recovered = set((lines.starts[i], lines.text(i)) for i in range(len(lines)))
+        self.assertTrue(recovered <= original)
+        self.assertGreater(len(recovered), 0.8 * len(original))
+        self.assertGreater(handler.bytes_resynced, 0)
+
+    def test_file_parser(self):
+        handler = SubtitleHandler()
+        with open(self.path, "rb") as fp:
+            quietly(mkvparse.mkvparse, fp, handler)
+        self.check_recovered(handler)
+
+    def test_buffer_parser(self):
+        handler = SubtitleHandler()
+        quietly(mkvparse.mkvparse_buffer, self.data, handler)
+        self.check_recovered(handler)
+
+    def test_resync_windows(self):
+        positions = range(1000, len(self.data), len(self.data) // 7)
+        expected = [quietly(mkvparse.resync_buffer, self.data, pos) for pos in positions]
+        self.assertTrue(all(pos is not None for pos in expected[:-1]))
+
+        chunk = mkvparse.RESYNC_CHUNK
+        mkvparse.RESYNC_CHUNK = 5 # IDs span windows
+        try:
+            self.assertEqual([quietly(mkvparse.resync_buffer, self.data, pos) for pos in positions], expected)
+        finally:
+            mkvparse.RESYNC_CHUNK = chunk
+
+        for pos, found in zip(positions, expected):
+            with io.BytesIO(self.data) as fp:
+                fp.seek(pos)
+                (id_, size, skipped) = quietly(mkvparse.resync, fp)
+                self.assertEqual(None if id_ is None else pos + skipped, found)
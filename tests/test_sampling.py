@@ -0,0 +1,94 @@
+from __future__ import division, unicode_literals
+
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+from io import open
+import mkvparse
+import pipeline
+from mkvhandler import SubtitleHandler, read_cue_clusters
+from benchmarks.synthetic import make_subtitles, make_retimed, make_mkv
+
+DURATION = 30*60*1000
+SAMPLE = 30
+
+
+class SamplingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.ref = make_subtitles(duration=DURATION, lines_per_minute=12, seed=7)
+        for cues in (True, False):
+            make_mkv(cls.path(cues), cls.ref, video_frame_size=100, cues=cues, seed=7)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    @classmethod
+    def path(cls, cues):
+        return os.path.join(cls.directory, "cues.mkv" if cues else "nocues.mkv")
+
+    def parse(self, cues, sample_lines, buffer):
+        """Returns SubtitleHandler after parsing file with cues or not, by the buffer or file parser"""
+        with open(self.path(cues), "rb") as fp:
+            handler = SubtitleHandler(read_cue_clusters(fp), sample_lines)
+            fp.seek(0)
+            if buffer:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    mkvparse.mkvparse_buffer(data, handler)
+                finally:
+                    data.close()
+            else:
+                mkvparse.mkvparse(fp, handler)
+        return handler
+
+    def test_every_nth_cue_cluster(self):
+        all_starts = set(line.start for line in self.ref)
+        for buffer in (False, True):
+            full = self.parse(True, None, buffer)
+            handler = self.parse(True, SAMPLE, buffer)
+            starts = handler.subtitle_tracks[3].starts.tolist()
+            self.assertTrue(SAMPLE // 2 <= len(starts) < 3*SAMPLE, len(starts)) # clusters hold a few lines
+            self.assertTrue(set(starts) <= all_starts)
+            self.assertGreater(max(starts), 0.9*DURATION) # spans the whole file
+            self.assertLess(handler.bytes_parsed, full.bytes_parsed / 5)
+
+    def test_stops_early_without_cues(self):
+        expected = [line.start for line in self.ref][:SAMPLE]
+        for buffer in (False, True):
+            full = self.parse(False, None, buffer)
+            handler = self.parse(False, SAMPLE, buffer)
+            self.assertEqual(handler.subtitle_tracks[3].starts.tolist(), expected)
+            self.assertLess(handler.bytes_parsed, full.bytes_parsed / 5)
+
+    def test_refine(self):
+        subs_path = os.path.join(self.directory, "subs.srt")
+        make_retimed(self.ref, shift=-2000, seed=7).save(subs_path)
+        settings = {"unit": 100, "t0": 5000, "decay": 0.98, "iterations": 400, "seed": 0}
+
+        calls = []
+        solver_driver = pipeline.solver_driver
+        def recording_driver(ref_timings, timings, x0=0, **kwargs):
+            calls.append((len(ref_timings), x0))
+            return solver_driver(ref_timings, timings, x0=x0, **kwargs)
+
+        for cues in (True, False):
+            del calls[:]
+            estimates = []
+            pipeline.solver_driver = recording_driver
+            try:
+                delta, error = pipeline.retime(self.path(cues), subs_path, settings, sample_lines=SAMPLE, refine=True,
+                                               estimated=lambda x, fx: estimates.append(x))
+            finally:
+                pipeline.solver_driver = solver_driver
+
+            self.assertEqual(len(estimates), 1)
+            self.assertAlmostEqual(estimates[0], 2000, delta=1000)
+            self.assertAlmostEqual(delta, 2000, delta=settings["unit"])
+            # sample first, then the full reference starting from the estimate
+            self.assertEqual(calls, [(calls[0][0], 0), (len(self.ref), estimates[0])])
+            self.assertLess(calls[0][0], 3*SAMPLE)
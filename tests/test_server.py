@@ -0,0 +1,139 @@
+from __future__ import division, unicode_literals
+
+import json
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+from io import open
+from six.moves import http_client
+import server
+from benchmarks.synthetic import make_subtitles, make_retimed
+
+# keeps a worker busy until the job is cancelled
+LONG_JOB = {"iterations": 10**8, "patience": 0, "step": 1000}
+
+
+class ServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.ref_path = os.path.join(cls.directory, "ref.srt")
+        ref = make_subtitles(duration=10*60*1000, seed=3)
+        ref.save(cls.ref_path)
+        cls.retimed = make_retimed(ref, shift=-2000, seed=3)
+
+        cls.check_interval = server.WORKER_CHECK_INTERVAL
+        server.WORKER_CHECK_INTERVAL = 0.1
+        cls.retimer = server.RetimeServer(workers=1, cache_entries=4)
+        cls.httpd = server.HTTPServer(("127.0.0.1", 0), server.RequestHandler)
+        cls.httpd.retimer = cls.retimer
+        cls.httpd.verbose = False
+        cls.thread = threading.Thread(target=cls.httpd.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+        cls.retimer.close()
+        server.WORKER_CHECK_INTERVAL = cls.check_interval
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.subs_path = os.path.join(self.directory, "%s.srt" % self.id().split(".")[-1])
+        self.retimed.save(self.subs_path)
+
+    def request(self, method, path, data=None):
+        connection = http_client.HTTPConnection("127.0.0.1", self.httpd.server_address[1], timeout=10)
+        try:
+            body = data if data is None or isinstance(data, bytes) else json.dumps(data).encode("utf-8")
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read().decode("utf-8"))
+        finally:
+            connection.close()
+
+    def submit(self, **options):
+        options.update(ref=self.ref_path, subs=self.subs_path)
+        status, reply = self.request("POST", "/jobs", options)
+        self.assertEqual(status, 202)
+        return reply["id"]
+
+    def wait(self, job_id, states=("done", "failed", "cancelled"), timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status, job = self.request("GET", "/jobs/%s" % job_id)
+            self.assertEqual(status, 200)
+            if job["state"] in states:
+                return job
+            time.sleep(0.05)
+        self.fail("job %s is still %s" % (job_id, job["state"]))
+
+    def read_subs(self):
+        with open(self.subs_path, "rb") as fp:
+            return fp.read()
+
+    def test_done(self):
+        job = self.wait(self.submit(method="fft", write=True))
+        self.assertEqual(job["state"], "done")
+        self.assertEqual(job["result"]["shift"], 2000)
+        self.assertTrue(job["result"]["written"])
+
+    def test_cancel_queued(self):
+        running = self.submit(**LONG_JOB)
+        queued = self.submit(method="fft")
+        self.assertEqual(self.request("GET", "/jobs/%s" % queued)[1]["state"], "queued")
+
+        self.assertEqual(self.request("DELETE", "/jobs/%s" % queued), (200, {"id": queued, "cancelled": True}))
+        self.assertEqual(self.request("GET", "/jobs/%s" % queued)[1]["state"], "cancelled")
+        self.assertEqual(self.request("DELETE", "/jobs/%s" % queued)[0], 409)
+
+        self.request("DELETE", "/jobs/%s" % running)
+        self.assertEqual(self.wait(running)["state"], "cancelled")
+        self.assertEqual(self.request("GET", "/jobs/%s" % queued)[1]["result"], None)
+
+    def test_cancel_running(self):
+        original = self.read_subs()
+        job_id = self.submit(write=True, **LONG_JOB)
+        self.wait(job_id, ("running",))
+        self.assertEqual(self.request("DELETE", "/jobs/%s" % job_id)[0], 200)
+        job = self.wait(job_id)
+        self.assertEqual(job["state"], "cancelled")
+        self.assertEqual(job["result"]["stop_reason"], "cancelled")
+        self.assertFalse(job["result"]["written"])
+        self.assertEqual(self.read_subs(), original)
+
+    def test_dead_worker(self):
+        job_id = self.submit(**LONG_JOB)
+        pid = None # known once the worker took the job
+        deadline = time.time() + 10
+        while pid is None and time.time() < deadline:
+            pid = self.request("GET", "/jobs/%s" % job_id)[1].get("worker")
+            time.sleep(0.05)
+        os.kill(pid, signal.SIGKILL)
+
+        job = self.wait(job_id)
+        self.assertEqual(job["state"], "failed")
+        self.assertIn("exited", job["result"]["failed"])
+        self.assertEqual(self.wait(self.submit(method="fft"))["state"], "done")
+        self.assertEqual(self.request("GET", "/status")[1]["idle_workers"], 1)
+
+    def test_bad_options(self):
+        for options in ({"unit": [1]}, {"method": "nope"}, {"objective": "nope"}, {"step": None}, {"nope": 1}):
+            options.update(ref=self.ref_path, subs=self.subs_path)
+            status, reply = self.request("POST", "/jobs", options)
+            self.assertEqual(status, 400, options)
+            self.assertIn("error", reply)
+        self.assertEqual(self.request("POST", "/jobs", {"ref": self.ref_path})[0], 400)
+        self.assertEqual(self.request("POST", "/jobs", b"{")[0], 400)
+
+    def test_unknown_job(self):
+        self.assertEqual(self.request("GET", "/jobs/999999")[0], 404)
+        self.assertEqual(self.request("GET", "/jobs/999999/progress")[0], 404)
+        self.assertEqual(self.request("GET", "/nope")[0], 404)
+        self.assertEqual(self.request("DELETE", "/jobs/999999")[0], 409)
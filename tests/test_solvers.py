@@ -0,0 +1,138 @@
+from __future__ import division, unicode_literals
+
+import random
+import unittest
+import numpy as np
+import pysubs2
+from algorithms import (get_clusters, discretize, cross_correlation_solver, drift_solver, piecewise_solver,
+                        IntervalMismatchObjective, UnitMismatchObjective)
+from timings import Timings
+from benchmarks.objective import set_objective
+from benchmarks.synthetic import make_subtitles, make_retimed
+
+UNIT = 100
+
+
+def clusters_of(subs):
+    return list(get_clusters(Timings.from_subs(subs)))
+
+def solve(solver):
+    for _, _, x, fx in solver:
+        pass
+    return x, fx
+
+
+class UnitMismatchObjectiveTest(unittest.TestCase):
+    def test_matches_set_objective(self):
+        ref = make_subtitles(duration=5*60*1000, lines_per_minute=20, seed=5)
+        ref_clusters = clusters_of(ref)
+        clusters = clusters_of(make_retimed(ref, shift=-2500, seed=5))
+        rng = random.Random(5)
+        # beyond both ends of the reference too, where the lookups are clipped
+        deltas = [rng.uniform(-400000, 400000) for _ in range(300)] + [-10**7, 10**7, 0, 2500, -1, 1]
+        for unit in (100, 37):
+            expected = set_objective(ref_clusters, clusters, unit)
+            objective = UnitMismatchObjective(ref_clusters, clusters, unit)
+            self.assertEqual([objective(delta) for delta in deltas], [expected(delta) for delta in deltas], unit)
+
+
+class IntervalMismatchObjectiveTest(unittest.TestCase):
+    def test_hand_computed(self):
+        ref = [(1000, 2000, None), (4000, 5000, None)]
+        clusters = [(1500, 2500, None), (4200, 4400, None)]
+        objective = IntervalMismatchObjective(ref, clusters, UNIT)
+        # delta -> overlap in ms, mismatch is (2000 + 1200 - 2*overlap) / UNIT
+        cases = {
+            0: 500 + 200,
+            -150: 650 + 200,
+            -600: 900 + 0,
+            500: 0 + 200, # first cluster just touches the end of the reference one
+            3000: 500 + 0, # second cluster past the end of the reference
+            -5000: 0, # both before the start
+            10**6: 0,
+        }
+        for delta, overlap in cases.items():
+            self.assertEqual(objective.overlap(delta), overlap, delta)
+            self.assertEqual(objective(delta), (3200 - 2*overlap) / UNIT, delta)
+        self.assertEqual(objective.cluster_overlaps([0, -600]).tolist(), [[500, 200], [900, 0]])
+
+
+class CrossCorrelationSolverTest(unittest.TestCase):
+    def test_matches_set_objective(self):
+        ref = make_subtitles(duration=60*1000, lines_per_minute=20, seed=4)
+        ref_clusters = clusters_of(ref)
+        for shift in (-2000, 3700):
+            clusters = clusters_of(make_retimed(ref, shift=shift, seed=4))
+            for unit in (100, 37):
+                objective = set_objective(ref_clusters, clusters, unit)
+                # all shifts where the subtitles can overlap, the first minimum has the smallest |shift|
+                shifts = sorted(range(-80*1000 // unit, 80*1000 // unit), key=abs)
+                mismatches = [objective(d*unit) for d in shifts]
+                best = mismatches.index(min(mismatches))
+
+                x, fx = solve(cross_correlation_solver(discretize(ref_clusters, unit), discretize(clusters, unit), unit))
+                self.assertEqual((x, fx), (shifts[best]*unit, mismatches[best]), (shift, unit))
+                self.assertLessEqual(abs(x + shift), unit)
+
+    def test_ties_go_to_smallest_shift(self):
+        self.assertEqual(solve(cross_correlation_solver([5, 6], [5], 100)), (0, 1))
+        self.assertEqual(solve(cross_correlation_solver([3, 4], [5], 100)), (-100, 1))
+
+
+class PiecewiseSolverTest(unittest.TestCase):
+    def cut_release(self, seed, cut=15*60*1000, removed=60000, shift=2000):
+        """Returns (reference, subtitles shifted by shift, with removed ms missing after cut)"""
+        ref = make_subtitles(duration=30*60*1000, lines_per_minute=20, seed=seed)
+        subs = pysubs2.SSAFile()
+        for line in make_retimed(ref, shift=0, seed=seed):
+            if cut <= line.start < cut + removed:
+                continue
+            delta = shift if line.start < cut else shift - removed
+            subs.append(pysubs2.SSAEvent(start=line.start + delta, end=line.end + delta, text=line.text))
+        return ref, subs
+
+    def test_finds_segments(self):
+        for seed in range(3):
+            ref, subs = self.cut_release(seed)
+            x, fx = solve(piecewise_solver(clusters_of(ref), clusters_of(subs), UNIT))
+            self.assertEqual(x.shifts, [-2000.0, 58000.0])
+            self.assertEqual(len(x.boundaries), 1)
+            self.assertLess(abs(x.boundaries[0] - (15*60*1000 + 2000)), 30000) # between lines around the cut
+            self.assertGreaterEqual(fx, 0)
+
+    def test_mismatch_of_shifts(self):
+        ref = [(0, 1000, None), (3000, 4000, None)]
+        clusters = [(0, 1000, None), (5000, 6000, None)]
+        objective = IntervalMismatchObjective(ref, clusters, UNIT)
+        self.assertEqual(objective.mismatch_of_shifts(np.array([0.0, 0.0])), objective(0))
+        # both clusters shifted onto the same reference cluster cover it once
+        self.assertEqual(objective.mismatch_of_shifts(np.array([0.0, -5000.0])), 10)
+        self.assertEqual(objective.mismatch_of_shifts(np.array([0.0, -2000.0])), 0)
+
+
+class DriftSolverTest(unittest.TestCase):
+    def scaled(self, ref, scale, offset):
+        """Returns ref with times t becoming scale*t + offset"""
+        subs = pysubs2.SSAFile()
+        for line in ref:
+            subs.append(pysubs2.SSAEvent(start=int(round(scale*line.start + offset)),
+                                         end=int(round(scale*line.end + offset)), text=line.text))
+        return subs
+
+    def check(self, scale, offset, scale_tolerance, offset_tolerance):
+        ref = make_subtitles(duration=30*60*1000, lines_per_minute=20, seed=2)
+        subs = self.scaled(ref, scale, offset)
+        x, fx = solve(drift_solver(clusters_of(ref), clusters_of(subs), UNIT))
+        # x maps subtitles back to the reference: t -> (t - offset) / scale
+        self.assertAlmostEqual(x.scale, 1 / scale, delta=scale_tolerance)
+        self.assertAlmostEqual(x.offset, -offset / scale, delta=offset_tolerance)
+        self.assertGreaterEqual(fx, 0)
+
+    def test_framerate_ratio(self):
+        self.check(25 / (24000/1001), 3000, 1e-9, UNIT)
+
+    def test_voted_scale(self):
+        self.check(1.013, -4000, 2e-4, 1000)
+
+    def test_no_drift(self):
+        self.check(1.0, 1500, 1e-9, UNIT)
@@ -0,0 +1,102 @@
+from __future__ import division, unicode_literals
+
+from array import array
+import numpy as np
+import pysubs2
+
+
+class Timings(object):
+    """
+    Start/end times (ms) of subtitle lines in parallel int32 arrays with a comment flag,
+    which is all the alignment needs. About 10 bytes per line instead of an SSAEvent.
+
+    The MKV parser appends lines directly, keeping raw UTF-8 payloads, which are decoded
+    only by text() or to_subs(). Order of lines is kept, clusters() sorts them.
+    """
+    def __init__(self):
+        self._starts = array("i")
+        self._ends = array("i")
+        self._comments = array("b")
+        self.payloads = []
+
+    @classmethod
+    def from_subs(cls, subs):
+        """Returns Timings of SSAFile (or any iterable of SSAEvent), without text"""
+        timings = cls()
+        for line in subs:
+            timings.append(line.start, line.end, comment=line.is_comment)
+        return timings
+
+    @classmethod
+    def from_arrays(cls, starts, ends):
+        timings = cls()
+        timings._starts.extend(int(t) for t in starts)
+        timings._ends.extend(int(t) for t in ends)
+        timings._comments.extend([0] * len(timings._starts))
+        timings.payloads = [None] * len(timings._starts)
+        return timings
+
+    def append(self, start, end, payload=None, comment=False):
+        self._starts.append(start)
+        self._ends.append(end)
+        self._comments.append(comment)
+        self.payloads.append(payload)
+
+    def extend(self, other):
+        """Appends all lines of other Timings"""
+        self._starts.extend(other._starts)
+        self._ends.extend(other._ends)
+        self._comments.extend(other._comments)
+        self.payloads.extend(other.payloads)
+
+    def __len__(self):
+        return len(self._starts)
+
+    @property
+    def starts(self):
+        return np.frombuffer(self._starts, dtype=np.int32) if self._starts else np.zeros(0, dtype=np.int32)
+
+    @property
+    def ends(self):
+        return np.frombuffer(self._ends, dtype=np.int32) if self._ends else np.zeros(0, dtype=np.int32)
+
+    @property
+    def comments(self):
+        return np.frombuffer(self._comments, dtype=np.int8).astype(bool) if self._comments else np.zeros(0, dtype=bool)
+
+    def text(self, i):
+        payload = self.payloads[i]
+        return "" if payload is None else payload.decode("utf-8")
+
+    def to_subs(self):
+        """Returns SSAFile with all lines, decoding their text"""
+        subs = pysubs2.SSAFile()
+        for i in range(len(self)):
+            line = pysubs2.SSAEvent(start=self._starts[i], end=self._ends[i], text=self.text(i))
+            if self._comments[i]:
+                line.type = "Comment"
+            subs.append(line)
+        return subs
+
+    def clusters(self, include_comments=False):
+        """
+        Yields (start, end, indices of lines) of groups of overlapping lines in time order,
+        like algorithms.get_clusters() does for SSAFile, but vectorized
+        """
+        index = np.arange(len(self))
+        if not include_comments:
+            index = index[~self.comments]
+        if not len(index):
+            return
+
+        starts, ends = self.starts[index], self.ends[index]
+        order = np.lexsort((ends, starts))
+        index, starts, ends = index[order], starts[order], ends[order]
+
+        reach = np.maximum.accumulate(ends)
+        first = np.flatnonzero(np.concatenate(([True], starts[1:] > reach[:-1])))
+        last = np.append(first[1:], len(index))
+        cluster_ends = np.maximum.reduceat(ends, first)
+
+        for i, j, start, end in zip(first.tolist(), last.tolist(), starts[first].tolist(), cluster_ends.tolist()):
+            yield start, end, index[i:j]